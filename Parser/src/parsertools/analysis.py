@@ -0,0 +1,130 @@
+'''
+Grammar analysis for parsers defined with base.py (see the Parser class in the parser definition files).
+
+analyzeGrammar() reports the alternations of a grammar whose alternatives may start at the same position, so that earlier
+alternatives are tried and fail before a later one matches, and the prefixes such alternatives share. reportGrammar() writes
+this as a readable report. A shared prefix P, as in P + X | P + Y, can be factored by hand into P + (X | Y); the SPARQL and N3
+grammars have none.
+'''
+import io
+from pyparsing import *
+from parsertools.base import ParseStruct, _firstSet
+
+class Alternation:
+    '''The analysis of an alternation (a MatchFirst pattern) in the grammar. Attributes:
+    element: the name of the element class whose pattern contains the alternation,
+    pattern: the alternation,
+    overlaps: a list of tuples (j, i, prefix) for the alternatives j < i that may start at the same position, where prefix is the
+    number of leading subpatterns they share,
+    cost: the estimated backtracking cost, the number of subpatterns parsed by earlier alternatives that fail before each
+    alternative matches, summed over the alternatives. An overlap counts for its shared prefix, and at least for 1.'''
+
+    def __init__(self, element, pattern, overlaps):
+        self.element = element
+        self.pattern = pattern
+        self.overlaps = overlaps
+        self.cost = sum(max(1, prefix) for _, _, prefix in overlaps)
+
+    def __str__(self):
+        return '{} ({} alternatives): cost {}, overlapping alternatives {}'.format(self.element, len(self.pattern.exprs), self.cost,
+            ', '.join('{}/{}{}'.format(j + 1, i + 1, ' (prefix {})'.format(prefix) if prefix else '') for j, i, prefix in self.overlaps))
+
+def _elements(parser, start):
+    '''Returns the patterns of the element classes in start, or of all element classes of parser if start is None, streamlined.'''
+    if start is None:
+        start = [c for c in vars(parser).values() if isinstance(c, type) and issubclass(c, ParseStruct) and getattr(c, '_pattern', None) is not None]
+    for c in start:
+        c._pattern.streamline()
+    return [(c.__name__, c._pattern) for c in start]
+
+def _alternations(parser, start):
+    '''Yields the MatchFirst patterns of the grammar, with the name of the element class whose pattern contains them. The patterns of
+    element classes, and their copies, are recognized by their parse actions; they are not entered from another element.'''
+    seen = set()
+    for name, pattern in _elements(parser, start):
+        stack = [pattern]
+        while stack:
+            p = stack.pop()
+            if id(p) in seen or (p.parseAction and p is not pattern):
+                continue
+            seen.add(id(p))
+            if isinstance(p, MatchFirst):
+                yield name, p
+            stack.extend(reversed(getattr(p, 'exprs', [])))
+            if isinstance(getattr(p, 'expr', None), ParserElement):
+                stack.append(p.expr)
+
+def _signature(pattern):
+    '''Returns a value that is equal for patterns that match the same strings with the same results, e.g. for two copies
+    of a terminal with the same results name. Patterns that are not terminals, sequences, alternations or simple wrappers
+    are only equal to themselves.'''
+    common = (type(pattern), pattern.resultsName, pattern.modalResults, pattern.saveAsList, tuple(id(f) for f in pattern.parseAction),
+              pattern.callDuringTry, id(pattern.failAction), tuple(id(e) for e in pattern.ignoreExprs), pattern.skipWhitespace,
+              ''.join(sorted(pattern.whiteChars)))
+    if isinstance(pattern, Regex):
+        return common + (pattern.pattern, pattern.flags)
+    elif isinstance(pattern, Keyword):
+        return common + (pattern.match, pattern.caseless, frozenset(pattern.identChars))
+    elif isinstance(pattern, (Literal, Empty)):
+        return common + (getattr(pattern, 'match', None),)
+    elif isinstance(pattern, (And, MatchFirst)) and not any(isinstance(e, And._ErrorStop) for e in pattern.exprs):
+        return common + tuple(_signature(e) for e in pattern.exprs)
+    elif isinstance(pattern, (Group, Suppress)):
+        return common + (_signature(pattern.expr),)
+    elif isinstance(pattern, Optional):
+        return common + (_signature(pattern.expr), id(pattern.defaultValue))
+    elif isinstance(pattern, (ZeroOrMore, OneOrMore)):
+        return common + (_signature(pattern.expr), id(pattern.not_ender))
+    elif isinstance(pattern, Forward):
+        # Copies of a Forward (e.g. Expression('expression')) refer to the original
+        return common + (id(pattern.expr),)
+    return (id(pattern),)
+
+def _sequence(pattern):
+    '''Returns the subpatterns of pattern if it is a plain sequence that can be split, or else a list with pattern itself.'''
+    if isinstance(pattern, And) and not pattern.resultsName and not pattern.parseAction and not pattern.failAction and \
+            not any(isinstance(e, And._ErrorStop) for e in pattern.exprs):
+        return list(pattern.exprs)
+    return [pattern]
+
+def _prefix(first, second):
+    '''Returns the number of leading subpatterns shared by the sequences first and second.'''
+    n = 0
+    while n < min(len(first), len(second)) and _signature(first[n]) == _signature(second[n]):
+        n += 1
+    return n
+
+def _overlap(first, second):
+    '''Returns True if the first sets (see base._firstSet()) first and second may start at the same position.'''
+    if first is None or second is None or first[3] or second[3]:
+        return True
+    return bool(first[0] & second[0]) or (first[1] and second[1]) or bool(first[2] & second[2])
+
+def _analyze(name, pattern, memo):
+    '''Returns the Alternation for the MatchFirst pattern.'''
+    firsts = [_firstSet(e, memo) for e in pattern.exprs]
+    sequences = [_sequence(e) for e in pattern.exprs]
+    overlaps = []
+    for i in range(len(pattern.exprs)):
+        for j in range(i):
+            if _overlap(firsts[j], firsts[i]):
+                overlaps.append((j, i, _prefix(sequences[j], sequences[i])))
+    return Alternation(name, pattern, overlaps)
+
+def analyzeGrammar(parser, start=None):
+    '''Returns the analysis (see Alternation) of the alternations in the grammar of parser that have overlapping alternatives,
+    ordered by decreasing cost. The grammar consists of the patterns of the element classes in start, or of all element
+    classes of parser if start is None.'''
+    memo = {}
+    result = [_analyze(name, p, memo) for name, p in _alternations(parser, start)]
+    return sorted((a for a in result if a.overlaps), key=lambda a: -a.cost)
+
+def reportGrammar(parser, start=None, out=None):
+    '''Returns a report of analyzeGrammar(parser, start), one line per alternation. If out is given, it must be a text stream,
+    to which the report is written, and None is returned.'''
+    if out is None:
+        out = io.StringIO()
+        reportGrammar(parser, start, out)
+        return out.getvalue()
+    for alternation in analyzeGrammar(parser, start):
+        out.write(str(alternation) + '\n')
@@ -3,12 +3,148 @@ Created on 3 mrt. 2016
 
 @author: jeroenbruijning
 '''
+import sys
+import io
+import gc
+import time
+import weakref
+import string
+import re
+from itertools import chain
 from pyparsing import *
 from parsertools import ParsertoolsException
 
+# Distance between consecutive numbers assigned by ParseStruct.numberElements(). The gaps allow the numbering of a replaced subtree
+# to be refreshed without renumbering the rest of the tree.
+
+_NUMBERGAP = 1 << 16
+
+# Parameters for the polynomial hash of renderings. The base is chosen such that the hash of a string
+# equals its UTF-32 encoding, read as an integer, modulo the (Mersenne) prime _HASHMOD.
+
+_HASHBASE = 1 << 32
+_HASHMOD = (1 << 61) - 1
+
+def _stringHash(s):
+    '''Returns the polynomial hash of string s, see _HASHBASE and _HASHMOD.'''
+    return int.from_bytes(s.encode('utf-32-be', 'surrogatepass'), 'big') % _HASHMOD
+
+# Validation levels, see Parser.setValidation() in the parser definition modules:
+# - 'off': no internal consistency checks
+# - 'cheap': only checks that take constant time, or time linear in the number of items of the element concerned
+# - 'full': all checks, including re-parsing elements after updateWith(). This is the default.
+
+VALIDATION_LEVELS = ('off', 'cheap', 'full')
+
+def _validationLevel(class_, validation=None):
+    '''Returns validation if not None, else the validation level of the parser that created class_ ('full' if there is no such parser).'''
+    if validation is None:
+        validation = class_._parser.validation if class_._parser else 'full'
+    if not validation in VALIDATION_LEVELS:
+        raise ParsertoolsException('Validation level must be one of {}, got {}'.format(VALIDATION_LEVELS, validation))
+    return validation
+
+# Sets an attribute of an element, bypassing ParseStruct.__setattr__()
+
+_setattr = object.__setattr__
+
+# Attributes of a ParseStruct, which are all None initially, see ParseStruct.__init__()
+
+_ATTRIBUTES = ('_items', '_label', '_parent', '_str', '_hash', '_len', '_labels', '_index', '_pre', '_post', '_depth', '_span')
+
+def _slotNames(class_):
+    '''Returns the names of all attribute slots of class_, including those declared in its base classes.'''
+    return [att for c in class_.__mro__ for att in c.__dict__.get('__slots__', ()) if att != '__weakref__']
+
+class _LazyItems(list):
+    '''Items of an element that have not been materialized yet: strings and elements shared with the original of a
+    lazy copy (see ParseStruct.copy()).'''
+    __slots__ = ()
+
+class _Chain(list):
+    '''Items of a compressed element, produced by the parse actions of a parser created with collapse=True. A compressed element
+    stands for a chain of elements, each of which has the next one as its single item. It is an instance of the first class in the chain,
+    and holds the items of the last element in the chain. The classes and labels of the other elements of the chain, which are elided,
+    are kept in links, outermost first. Elided elements are created when they are needed, see ParseStruct._expand().'''
+    
+    __slots__ = ('links',)
+    
+    def __init__(self, items, links):
+        list.__init__(self, items)
+        self.links = links
+
+_sharedLeaves = {}
+
+# The lazy copies (see ParseStruct.copy()) made of each element, as a dict mapping id(element) to a tuple (weak reference to the element,
+# list of weak references to its copies). The copies of an element are completed before the element, or an element below it, is changed.
+# A copy leaves the registry when it is collected, and an element when it is collected or has no copies left.
+
+_lazyCopies = {}
+
+def _forgetLazyCopy(key, ref):
+    '''Removes ref, the weak reference to a lazy copy that has been collected, from the entry for its original in _lazyCopies.'''
+    entry = _lazyCopies.get(key)
+    if entry is not None:
+        entry[1][:] = [r for r in entry[1] if not r is ref]
+        if not entry[1]:
+            del _lazyCopies[key]
+
+def _sharedLeaf(class_, text, label):
+    '''Returns the shared leaf element of class class_, with text as its single item and the given label, creating it if needed.
+    Shared leaves are used for fixed-text terminals by parsers created with shareLeaves=True. Their items are kept in a tuple;
+    they are never changed, and have no parent pointer, no numbering and no context of their own, as they occur at many places.
+    They are only stored in the items of their parents, which replace them by elements of their own when they are handed out:
+    by getItems() (and so by getChildren(), iterElements() and dot access) and by a search that finds them, see ParseStruct._unshare().
+    Rendering, dump(), hasParentPointers(), indexes, and searches that do not find them leave them shared.'''
+    key = (class_, text, label)
+    result = _sharedLeaves.get(key)
+    if result is None:
+        result = class_(None)
+        result._set('_label', label)
+        result._set('_str', text)
+        result._set('_items', (text,))
+        result._computeHash()
+        _sharedLeaves[key] = result
+    return result
+
+def _isFixedText(class_):
+    '''Returns True if the elements of class_ always consist of the same text, i.e. if its _pattern is a literal or keyword.'''
+    return isinstance(class_._pattern, (Literal, Keyword))
+
+def _itemsHash(items):
+    '''Returns the polynomial hash and the length of the rendering of items, i.e. the items joined by single spaces, skipping items that
+    render as empty strings. The hashes and lengths of the non-string items are taken from their _hash and _len attributes.'''
+    h = 0
+    n = 0
+    for t in items:
+        if isinstance(t, str):
+            th, tn = _stringHash(t), len(t)
+        else:
+            th, tn = t._hash, t._len
+        if tn == 0:
+            continue
+        if n == 0:
+            h, n = th, tn
+        else:
+            h = _joinHash(h, th, tn)
+            n += tn + 1
+    return h, n
+
+def _joinHash(h, th, tn):
+    '''Returns the hash of the rendering with hash h, followed by a space and a rendering with hash th and length tn.
+    As _HASHMOD is 2**61 - 1, multiplying by _HASHBASE ** tn modulo _HASHMOD is a shift by 32 * tn modulo 61 bits.'''
+    return ((((h << 32) + 32) << (32 * tn % 61)) + th) % _HASHMOD
+
 class ParseStruct:
     '''Parent class for all ParseStruct subclasses. These subclasses will typically correspond to productions in a given grammar,
-    e.g. an EBNF grammar.'''
+    e.g. an EBNF grammar.
+    Instances store their attributes in slots instead of a __dict__, to keep large parse trees compact. Subclasses must declare
+    their own (possibly empty) __slots__ to keep this benefit.'''
+    
+    __slots__ = _ATTRIBUTES + ('__weakref__',)
+    
+    # Set by the parser for the classes it generates
+    _parser = None
     
     def __init__(self, expr):
         '''A ParseStruct object contains a _pattern attribute, that corresponds to a pyparsing _pattern.
@@ -21,37 +157,65 @@ class ParseStruct:
         - another ParseStruct object.
         
         This nested list is the basic internal structure for the class.
-        The other attibutes: _label and _parent_, are context dependent and will be set by a containing higher level ParseStruct, if that exists.'''
+        The other attibutes: _label and _parent_, are context dependent and will be set by a containing higher level ParseStruct, if that exists.
+        The attribute _str caches the rendering of the element. It is None as long as the element has not been rendered, or when its
+        rendering has been invalidated by a change of the element or of one of its descendants.
+        The attributes _hash and _len hold the polynomial hash and the length of the rendering. Like the rendering, they are computed
+        when first needed, bottom-up from the items but without rendering, and cached; they are None otherwise (see _hashLen()).
+        The attribute _labels indexes the direct subelements by label. It is a dict mapping each label to the list of subelements
+        having that label. It is built when first needed and cleared each time the items are set; it is None otherwise (see _labelIndex()).
+        The attribute _index holds an optional ElementIndex for the tree below the element, see buildIndex().
+        The attributes _pre, _post and _depth hold the pre-order and post-order numbers and the depth of the element, see numberElements().
+        They are None if the tree has not been numbered.
+        The attribute _span is a tuple (source, start, end), recording the string the element was parsed from and the position of the
+        element in it, if the parser keeps spans. It is None otherwise, and for elements that have been changed since parsing.'''
         
-        self.__dict__['_items'] = None
-        self.__dict__['_label'] = None
-        self.__dict__['_parent'] = None
+        for setter in _INITIALIZERS:
+            setter(self, None)
         
         if not expr is None:
             assert isinstance(expr, str), type(expr)
-            other = self.__getPattern().parseString(expr, parseAll=True)[0]
-            for attr in other.__dict__:
-                self.__dict__[attr] = other.__dict__[attr]
-            self.createParentPointers()
+            other = _parse(self.__class__, expr)
+            for attr in _slotNames(self.__class__):
+                _setattr(self, attr, getattr(other, attr))
+            if other._isShared():
+                _setattr(self, '_items', list(other._items))
+            self._linkItems()
                 
     def __eq__(self, other):
         '''Compares the instances for equality of:
         - class
         - string representation.
         This means that the labels, parent pointers etc. are not taken into account. This is because
-        these are a form of annotation and/or context, separate from the parse tree in terms of resolved production rules.'''
+        these are a form of annotation and/or context, separate from the parse tree in terms of resolved production rules.
+        The comparison of the string representations is skipped when the hashes of these representations differ.'''
         
-        return self.__class__ == other.__class__ and str(self) == str(other)
+        if self is other:
+            return True
+        if self.__class__ != other.__class__:
+            return False
+        if self._hashLen() != other._hashLen():
+            return False
+        return str(self) == str(other)
     
     def __ne__(self, other):
         return not self == other
     
+    def __hash__(self):
+        '''Returns a hash based on the class and the string representation, consistent with __eq__.
+        The hash changes when the element or one of its descendants is changed. Elements that are in use as dict keys or
+        set members should therefore not be changed.'''
+        
+        return hash((self.__class__.__name__, self._hashLen()[0]))
+    
     def __getattr__(self, att):
         '''Retrieves the unique, direct subelement having a label equal to the argument, if it exists.
         Raises an exception if zero, or more than one values exist for that label.'''
         
-        if att in self.getLabels():
-            values = self.getValuesForLabel(att)
+        if att.startswith('_'):
+            raise AttributeError('No attribute "{}".'.format(att))
+        values = self._labelIndex().get(att)
+        if values:
             if len(values) == 1:
                 return values[0] 
         else:
@@ -62,21 +226,33 @@ class ParseStruct:
         
         raise AttributeError('Direct setting of attributes not allowed. To change an element e, try e.updateWith() instead.')
     
+    def _set(self, att, value):
+        '''Sets attribute att, bypassing __setattr__. For internal use only. Shared leaves (see _sharedLeaf()) cannot be changed.'''
+        if self._items.__class__ is tuple:
+            raise ParsertoolsException('Shared leaf elements cannot be changed')
+        _setattr(self, att, value)
+    
     def __repr__(self):
         return self.__class__.__name__ + '("' + str(self) + '")'
     
     def __str__(self):
         '''Generates a string corresponding to the object. Except for possible whitespace variation, 
-        this is identical to the string that was used to create the object.'''
+        this is identical to the string that was used to create the object.
+        The result is cached, see also _invalidate(). Elements without a cached rendering are rendered bottom-up,
+        without recursion, so there is no limit to the depth of the tree.'''
         
-        result = []
-        for t in self._items:
-            if isinstance(t, str):
-                result.append(t) 
-            else:
-                assert isinstance(t, ParseStruct), '__str__: found value {} of type {} instead of ParseStruct instance'.format(t, type(t))
-                result.append(str(t))
-        return ' '.join([r for r in result if r != ''])
+        if self._str is None:
+            for e in self._iterStored(postorder=True, prune=lambda e: e._str is not None):
+                if e._str is None:
+                    result = []
+                    for t in e._items:
+                        if isinstance(t, str):
+                            result.append(t) 
+                        else:
+                            assert isinstance(t, ParseStruct), '__str__: found value {} of type {} instead of ParseStruct instance'.format(t, type(t))
+                            result.append(t._str)
+                    e._set('_str', ' '.join([r for r in result if r != '']))
+        return self._str
 
     def __getPattern(self):
         '''Returns the _pattern used to parse expressions for this class.'''
@@ -87,81 +263,434 @@ class ParseStruct:
         at any depth of recursion.
         If labeledOnly is True, then in addition label may not be None.'''
         
-        def flattenElement(p):
-            result = []
-            if isinstance(p, ParseStruct):
-                result.extend(p.__getElements(labeledOnly=labeledOnly))
-            else:
-                assert isinstance(p, str), type(p)
-            return result
-        
-        def flattenList(l):
-            result = []
-            for p in l:
-                result.extend(flattenElement(p))
-            return result
+        return [e for e in self.iterElements() if e.getLabel() or not labeledOnly]
+    
+    def iterElements(self, *, postorder=False, prune=None):
+        '''Generates the element itself and all embedded ParseStruct instances, at any depth of recursion, in pre-order
+        (the default) or in post-order. The tree is walked lazily, so the caller can stop at any point.
+        If prune is given, it must be a function taking an element. The elements below an element for which it returns True
+        are skipped (the element itself is still generated).
+        The tree must not be changed while the generator is in use.'''
         
-        result = []
-        if self.getLabel() or not labeledOnly:
-                result.append(self)
-        result.extend(flattenList(self.getItems()))
-        return result  
+        return self._walk(ParseStruct.getItems, postorder, prune)
+    
+    def _iterStored(self, *, postorder=False, prune=None):
+        '''As iterElements(), but without expanding compressed elements: the elements elided by them are not generated (see _Chain).'''
+        return self._walk(ParseStruct._storedItems, postorder, prune)
+    
+    def _iterIndexed(self):
+        '''As iterElements(), but without replacing shared leaves by elements of their own: these are generated as they are
+        (see _sharedLeaf()). These are the elements an index holds, see buildIndex().'''
+        return self._walk(ParseStruct._expandedItems, False, None)
+    
+    def _walk(self, items, postorder, prune):
+        '''Generates the elements for iterElements(), taking the items of each element from the function items.'''
+        if postorder:
+            stack = [(self, False)]
+            while stack:
+                e, expanded = stack.pop()
+                if expanded or (prune and prune(e)):
+                    yield e
+                    continue
+                stack.append((e, True))
+                for i in reversed(items(e)):
+                    if isinstance(i, ParseStruct):
+                        stack.append((i, False))
+                    else:
+                        assert isinstance(i, str), type(i)
+        else:
+            stack = [self]
+            while stack:
+                e = stack.pop()
+                yield e
+                if prune and prune(e):
+                    continue
+                for i in reversed(items(e)):
+                    if isinstance(i, ParseStruct):
+                        stack.append(i)
+                    else:
+                        assert isinstance(i, str), type(i)
     
     def createParentPointers(self, recursive=True):
-        for i in self.getItems():
-            if isinstance(i, ParseStruct):
-                i.__dict__['_parent'] = self
-                if recursive:
-                    i.createParentPointers()
-
-    def copy(self):
-        '''Returns a deep copy of itself.'''
-        result = self._pattern.parseString(str(self))[0]
-        assert result == self
+        '''Sets the parent pointers of the direct subelements, or, if recursive is True, of all elements below the element.
+        Shared leaves (see _sharedLeaf()) are left as they are, and compressed elements are not expanded (see _Chain).'''
+        for e in self._iterStored() if recursive else [self]:
+            link = e._link()
+            for i in e._storedItems():
+                if isinstance(i, ParseStruct) and not i._isShared():
+                    i._set('_parent', link)
+
+    def copy(self, *, deep=True, lazy=False):
+        '''Returns a copy of itself, without parent. The copy is made by cloning elements, without re-parsing. Labels, the attributes
+        of subclasses (such as the prefixes and base iri of a SPARQLElement) and cached renderings are kept, and parent pointers are set
+        in the copy. If the element holds an index (see buildIndex()), an index is built for a (non-lazy) deep copy as well.
+        - If deep is True (the default), all elements below the element are cloned as well.
+        - If deep is False, only the element itself is cloned. Its items are shared with the original, and still have the original
+          as their parent. This is only meant for read access, or for replacing the items of the copy as a whole with updateWith().
+        - If lazy is True, a deep copy is returned in which the elements below the element are cloned only when they are first accessed
+          (through getItems(), dot access or a search). Elements that are not accessed remain shared with the original until the original,
+          or an element below it, is changed with setItems(), updateWith() or a batch edit: the rest of the copy is then cloned first,
+          so that the copy keeps the contents the original had when it was copied.'''
+        
+        assert deep or not lazy, 'A lazy copy is always deep'
+        if lazy:
+            # The hashes are computed first, so that the clones take them over
+            self._hashLen()
+            result = self._clone(_LazyItems(self.getItems()))
+            key = id(self)
+            if not key in _lazyCopies:
+                _lazyCopies[key] = (weakref.ref(self, lambda _: _lazyCopies.pop(key, None)), [])
+            _lazyCopies[key][1].append(weakref.ref(result, lambda ref: _forgetLazyCopy(key, ref)))
+        elif deep:
+            clones = {}
+            for e in self._iterStored(postorder=True):
+                items = [clones[id(i)] if isinstance(i, ParseStruct) else i for i in e._items]
+                clones[id(e)] = e if e._isShared() else e._clone(_Chain(items, e._items.links) if e._isCompressed() else items)
+            result = clones[id(self)]
+        else:
+            result = self._clone(list(self.getItems()))
+            # The items remain children of the original
+            link = self._link()
+            for i in self._items:
+                if isinstance(i, ParseStruct) and not i._isShared():
+                    i._set('_parent', link)
+        if deep and not lazy and self._index:
+            result.buildIndex()
+        return result
+    
+    def _clone(self, items):
+        '''Returns a new element of the same class with the same attributes, except for parent, index and numbering, and with items
+        as its items. The parent pointers of the items are set to the new element, unless items is a _LazyItems instance.'''
+        result = self.__class__.__new__(self.__class__)
+        for attr in _slotNames(self.__class__):
+            _setattr(result, attr, getattr(self, attr))
+        _setattr(result, '_parent', None)
+        _setattr(result, '_index', None)
+        _setattr(result, '_pre', None)
+        _setattr(result, '_post', None)
+        _setattr(result, '_depth', None)
+        _setattr(result, '_labels', None)
+        _setattr(result, '_items', items)
+        result._linkItems()
         return result
     
+    def _materialize(self):
+        '''Replaces the items of an element that have not been materialized yet (see _LazyItems), which are shared with the original of
+        a lazy copy, by lazy copies of these items. The items of the new elements are not materialized in turn. Subclasses can extend
+        this method to pass context to the new elements.'''
+        items = [i._clone(_LazyItems(i.getItems())) if isinstance(i, ParseStruct) and not i._isShared() else i for i in self._items]
+        self._set('_items', items)
+        self._linkItems()
+    
+    def _completeLazyCopies(self):
+        '''Clones the elements not cloned yet of the lazy copies (see copy()) of the element and of its ancestors, before the element is changed.'''
+        elt = self
+        while elt is not None and _lazyCopies:
+            entry = _lazyCopies.pop(id(elt), None)
+            if entry is not None and entry[0]() is elt:
+                for ref in entry[1]:
+                    if ref() is not None:
+                        for _ in ref()._iterStored():
+                            pass
+            elt = elt._up()
+    
+    def _isLazy(self):
+        '''Returns True if the items of the element have not been materialized yet.'''
+        return self._items.__class__ is _LazyItems
+    
+    def _isCompressed(self):
+        '''Returns True if the element stands for a chain of elements, see _Chain.'''
+        return self._items.__class__ is _Chain
+    
+    def _isShared(self):
+        '''Returns True if the element is a shared leaf, see _sharedLeaf().'''
+        return self._items.__class__ is tuple
+    
+    def _storedItems(self):
+        '''Returns the items of the element as stored, i.e. for a compressed element the items of the last element of its chain,
+        and with shared leaves as they are. Items that have not been materialized yet are materialized.'''
+        if self._items.__class__ is _LazyItems:
+            self._materialize()
+        return self._items
+    
+    def _expandedItems(self):
+        '''Returns the items of the element as getItems() does, but with shared leaves as they are.'''
+        if self._items.__class__ is _LazyItems:
+            self._materialize()
+        elif self._items.__class__ is _Chain:
+            self._expand()
+        return self._items
+    
+    def _unshare(self):
+        '''Replaces the shared leaves (see _sharedLeaf()) among the items of the element by elements of their own, which have the element
+        as their parent, and returns the new elements. The new elements are numbered within the interval of the element, if there is room.'''
+        items = self._items
+        new = []
+        for k, i in enumerate(items):
+            if isinstance(i, ParseStruct) and i._items.__class__ is tuple:
+                items[k] = i._clone(list(i._items))
+                new.append(items[k])
+        if not new:
+            return new
+        self._linkItems()
+        if self._pre is not None:
+            # Each run of new elements is numbered in the gap between the numbered elements around it
+            ids = set(id(e) for e in new)
+            low = self._pre
+            run = []
+            for i in [i for i in items if isinstance(i, ParseStruct) and not i._isShared()] + [None]:
+                if i is not None and id(i) in ids:
+                    run.append(i)
+                    continue
+                high = self._post if i is None else i._pre
+                step = (high - low) // (2 * len(run) + 1)
+                if run and step == 0:
+                    self.getRoot().numberElements()
+                    break
+                for j, e in enumerate(run):
+                    _setattr(e, '_pre', low + (2 * j + 1) * step)
+                    _setattr(e, '_post', low + (2 * j + 2) * step)
+                    _setattr(e, '_depth', self._depth + 1)
+                run = []
+                if i is not None:
+                    low = i._post
+        return new
+    
+    def _collapse(self):
+        '''Compresses the element if it has a single item that is an element, taking over the items of that element. See _Chain.'''
+        if len(self._items) == 1 and isinstance(self._items[0], ParseStruct):
+            child = self._items[0]
+            links = ((child.__class__, child._label),) + (child._items.links if child._isCompressed() else ())
+            self._set('_items', _Chain(child._items, links))
+            self._linkItems()
+    
+    def _expand(self, position=0):
+        '''Creates the element elided by a compressed element at position in its links, which takes over the rest of the chain, and
+        returns it. The elements elided before it remain elided: the compressed element keeps them, with the new element as its
+        single stored item. The new element is numbered within the interval of the element, if there is room.'''
+        links = self._items.links
+        class_, label = links[position]
+        child = class_.__new__(class_)
+        for attr in _slotNames(class_):
+            _setattr(child, attr, getattr(self, attr))
+        child._set('_label', label)
+        child._set('_index', None)
+        child._set('_items', _Chain(self._items, links[position + 1:]) if position + 1 < len(links) else list(self._items))
+        child._linkItems()
+        self._set('_items', _Chain([child], links[:position]) if position else [child])
+        self._linkItems()
+        if self._pre is not None:
+            elements = [i for i in child._items if isinstance(i, ParseStruct) and not i._isShared()]
+            pre = (self._pre + (elements[0]._pre if elements else self._post)) // 2
+            post = (max(pre, elements[-1]._post if elements else pre) + self._post) // 2
+            child._set('_pre', pre)
+            child._set('_post', post)
+            child._set('_depth', self._depth + position + 1)
+            if not (self._pre < pre < post < self._post and (not elements or (pre < elements[0]._pre and elements[-1]._post < post))):
+                self.getRoot().numberElements()
+        return child
+    
     def setItems(self, items):
-        self.__dict__['_items'] = items
+        '''Sets the items attribute, sets the parent pointers of the items to the element, clears the label index,
+        and invalidates the cached rendering of the element and its ancestors.
+        As the parse actions build each element with setItems(), parsed trees have their parent pointers set on construction.
+        A new element, whose items have not been set yet, has no parent and nothing cached, so nothing is invalidated.'''
+        assert not self._isShared(), 'Shared leaf elements cannot be changed'
+        fresh = self._items is None
+        if not fresh and _lazyCopies:
+            self._completeLazyCopies()
+        _setattr(self, '_items', items)
+        self._linkItems()
+        if not fresh:
+            self._invalidate()
+    
+    def _linkItems(self):
+        '''Sets the parent pointers of the direct subelements to the element, and clears the _labels attribute (see _labelIndex()).
+        Does nothing but clearing _labels if the items have not been materialized yet. For a compressed element, the parent pointers
+        of its stored items are set. Shared leaves (see _sharedLeaf()) do not get a parent pointer.'''
+        _setattr(self, '_labels', None)
+        items = self._items
+        if items.__class__ is _LazyItems:
+            return
+        link = self._link()
+        for i in items:
+            if isinstance(i, ParseStruct) and i._items.__class__ is not tuple:
+                _setattr(i, '_parent', link)
+    
+    def _link(self):
+        '''Returns the value to be stored as parent pointer in the subelements of the element: the element itself, or a weak reference
+        to it if its parser was created with weakParents=True. See _up().'''
+        parser = self._parser
+        return weakref.ref(self) if parser is not None and parser.weakParents else self
     
-    def searchElements(self, *, label=None, element_type = None, value = None, labeledOnly=False):
+    def _up(self):
+        '''Returns the element pointed to by the parent pointer, or None. For internal use, see getParent().'''
+        parent = self._parent
+        return parent() if parent.__class__ is weakref.ref else parent
+    
+    def _invalidate(self):
+        '''Clears the cached rendering and hash of the element and of all its ancestors, following the parent pointers.
+        Must be called whenever the items of the element change.'''
+        elt = self
+        while elt is not None:
+            _setattr(elt, '_str', None)
+            _setattr(elt, '_span', None)
+            _setattr(elt, '_hash', None)
+            elt = elt._up()
+    
+    def _hashLen(self):
+        '''Returns the tuple (_hash, _len) of the element, first computing them for the elements below it that have none,
+        bottom-up and without recursion.'''
+        if self._hash is None:
+            for e in self._iterStored(postorder=True, prune=lambda e: e._hash is not None):
+                if e._hash is None:
+                    e._computeHash()
+        return self._hash, self._len
+    
+    def _computeHash(self):
+        '''Computes the _hash and _len attributes from those of the items, which must have been computed. These correspond to the
+        rendering of the element, i.e. the items joined by single spaces, skipping items that render as empty strings.'''
+        h, n = _itemsHash(self._items)
+        _setattr(self, '_hash', h)
+        _setattr(self, '_len', n)
+    
+    def searchElements(self, *, label=None, element_type = None, value = None, text = None, labeledOnly=False):
         '''Returns a list of all elements with the specified search _pattern. If labeledOnly is True,
         only elements with label not None are considered for inclusion. Otherwise (the default case) all elements are considered.
-        Keyword arguments label, element_type, value are used as a wildcard if None. All must be matched for an element to be included in the result.'''
+        Keyword arguments label, element_type, value, text are used as a wildcard if None. All must be matched for an element to be included in the result.
+        An element matches value if it equals the result of parsing value with the _pattern of the element. The value is parsed
+        only once for each class encountered.
+        An element matches text if its rendering equals text. No parsing is involved.'''
         
-        result = []
+        return list(self.__search(label=label, element_type=element_type, value=value, text=text, labeledOnly=labeledOnly))
+    
+    def searchFirst(self, *, label=None, element_type = None, value = None, text = None, labeledOnly=False):
+        '''Returns the first element, in pre-order, that would be found by searchElements() with the same arguments, or None if there
+        is no such element. The search stops at the first match.'''
         
-        for e in [self] + self.__getElements(labeledOnly=labeledOnly):
-#             print('DEBUG: e.name =', e.getLabel())
-
+        return next(self.__search(label=label, element_type=element_type, value=value, text=text, labeledOnly=labeledOnly), None)
+    
+    def __search(self, *, label, element_type, value, text, labeledOnly):
+        '''Generates the results for searchElements() and searchFirst().'''
+        
+        parsedvalues = {}
+        if text:
+            texthash = _stringHash(text)
+        
+        if self._index and (element_type or label) and self._index.covers(element_type=element_type, label=label):
+            candidates = ((e, None, None) for e in [self] + self._index.getElements(element_type=element_type, label=label))
+        else:
+            # Of the elements elided by a compressed element, only the first one that could match is created (see _expand()),
+            # and the walk goes on from there
+            def items(e):
+                if e._isCompressed():
+                    for position, (c, l) in enumerate(e._items.links):
+                        if (not element_type or c is element_type) and (not label or l == label) and (l or not labeledOnly):
+                            e._expand(position)
+                            break
+                    return e._items
+                return e._expandedItems()
+            def walk():
+                # Generates each element with the element containing it and its position there, so that a shared leaf that
+                # matches can be replaced by an element of its own
+                stack = [(self, None, None)]
+                while stack:
+                    e, container, position = stack.pop()
+                    yield e, container, position
+                    stored = items(e)
+                    for n in reversed(range(len(stored))):
+                        if isinstance(stored[n], ParseStruct):
+                            stack.append((stored[n], e, n))
+            candidates = chain([(self, None, None)], walk())
+        
+        for e, container, position in candidates:
             if labeledOnly and not e.getLabel():
                 continue
             if label and label != e.getLabel():
                 continue
             if element_type and element_type != e.__class__:
                 continue
+            if text and (e._hashLen() != (texthash, len(text)) or str(e) != text):
+                continue
             if value:
-                try:
-                    e1 = e._pattern.parseString(value)[0]
-                    if e != e1:
-                        continue
-                except ParseException:
+                if not e.__class__ in parsedvalues:
+                    try:
+                        parsedvalues[e.__class__] = e._pattern.parseString(value)[0]
+                    except ParseException:
+                        parsedvalues[e.__class__] = None
+                e1 = parsedvalues[e.__class__]
+                if e1 is None or e != e1:
                     continue
-            result.append(e)
-        return result    
+            if container is not None and e._isShared():
+                # The containing element replaces its shared leaves by elements of their own, see _unshare()
+                if container._isCompressed():
+                    container = container._expand(len(container._items.links) - 1)
+                container._unshare()
+                e = container._items[position]
+            yield e
 
-    def updateWith(self, new_content):
+    def updateWith(self, new_content, *, validation=None):
         '''Replaces the items attribute with the items attribute of a freshly parsed new_content, which must be a string.
         The parsing is done with the _pattern of the element being updated.
-        This is the core function to change elements in place.'''
+        This is the core function to change elements in place.
+        The argument validation overrides the validation level of the parser (see VALIDATION_LEVELS). At level 'full', the element is
+        re-parsed after the update; at level 'cheap', only the parent pointers of its children are checked.'''
         
+        if self._isShared():
+            raise ParsertoolsException('Shared leaf element {} cannot be changed'.format(self.__class__.__name__))
+        validation = _validationLevel(self.__class__, validation)
+        items = self._parseContent(new_content)
+        indexes = self._indexes()
+        if indexes:
+            old = list(self._iterIndexed())[1:]
+            for index in indexes:
+                index.remove(old)
+        self.setItems(items)
+        self._renumber()
+        if indexes:
+            new = list(self._iterIndexed())[1:]
+            for index in indexes:
+                index.add(new)
+        if validation == 'full':
+            assert self.isValid()
+        elif validation == 'cheap':
+            assert all(c._up() is self for c in self.getChildren())
+    
+    def _parseContent(self, new_content):
+        '''Parses new_content with the _pattern of the element, as done by updateWith(), and returns the items of the result.
+        The items of a shared leaf are copied, as they are installed in the element, which is not shared.'''
         assert isinstance(new_content, str), 'UpdateFrom function needs a string'
         try:
-            other = self._pattern.parseString(new_content, parseAll=True)[0]
+            other = _parse(self.__class__, new_content)
         except ParseException:
-            raise ParsertoolsException('{} is not a valid string for {} element'.format(new_content, self.__class__.__name__))        
-        self.__dict__['_items'] = other.__dict__['_items']
-        self.createParentPointers(recursive=False)
-        assert self.isValid()
+            raise ParsertoolsException('{} is not a valid string for {} element'.format(new_content, self.__class__.__name__))
+        return list(other._items) if other._isShared() else other._items
+    
+    def batchEdit(self, *, validation=None):
+        '''Returns a BatchEdit object, to replace the contents of several elements in the tree below the element in one operation.'''
+        return BatchEdit(self, validation=validation)
+    
+    def buildIndex(self):
+        '''Builds an index of all elements in the tree below (and including) the element, by class and by label.
+        Searches from this element by element_type or label then use the index instead of traversing the tree.
+        The index is maintained by updateWith() and batch edits, applied to the element or to any element below it; the indexes of
+        all elements on the path from an updated element to the root are updated. Other changes to the tree are not tracked;
+        call buildIndex() again after such changes.'''
+        self._set('_index', ElementIndex(self, self._iterIndexed()))
+    
+    def _indexes(self):
+        '''Returns the indexes (see buildIndex()) held by the element and its ancestors, which cover the elements below the element.'''
+        result = []
+        elt = self
+        while elt is not None:
+            if elt._index:
+                result.append(elt._index)
+            elt = elt._up()
+        return result
+    
+    def removeIndex(self):
+        '''Removes the index built by buildIndex().'''
+        self._set('_index', None)
     
     def check(self, *, report = False, render=False, dump=False):
         '''Runs various checks. Returns True if all checks pass, else False. Optionally prints a report with the check results, renders, and/or dumps itself.'''
@@ -181,12 +710,15 @@ class ParseStruct:
         return self._label
 
     def getItems(self):
-        '''Returns items attribute.'''
-        return self._items
+        '''Returns items attribute. Shared leaves among the items are first replaced by elements of their own, see _unshare().'''
+        items = self._expandedItems()
+        if items.__class__ is list:
+            self._unshare()
+        return items
 
     def hasLabel(self, k):
         '''True if k present as label of a direct descendant.'''
-        return k in self.getLabels()
+        return k in self._labelIndex()
      
     def getLabels(self):
         '''Returns list of all labels from direct descendants.'''
@@ -194,7 +726,20 @@ class ParseStruct:
     
     def getValuesForLabel(self, k):
         '''Returns list of all direct descendants with k as label.'''
-        return [i for i in self.getItems() if isinstance(i, ParseStruct) and i._label == k]
+        if k is None:
+            return [i for i in self.getItems() if isinstance(i, ParseStruct) and i._label is None]
+        return list(self._labelIndex().get(k, []))
+    
+    def _labelIndex(self):
+        '''Returns the _labels attribute, first building it from the labels of the items if needed.'''
+        items = self.getItems()
+        if self._labels is None:
+            labels = {}
+            for i in items:
+                if isinstance(i, ParseStruct) and i._label:
+                    labels.setdefault(i._label, []).append(i)
+            _setattr(self, '_labels', labels)
+        return self._labels
     
     def getChildren(self):
         '''Returns a list of all its non-string child elements.'''
@@ -202,8 +747,107 @@ class ParseStruct:
     
     def getParent(self):
         '''Returns its parent element, which is the first element encountered when going up in the parse tree.
-        For the top element, the method returns None'''
-        return self._parent
+        For the top element, the method returns None. Shared leaves (see _sharedLeaf()) are replaced by elements of their own when the
+        items of their parent are accessed, so elements reached from the tree have their parent.
+        If the parser was created with weakParents=True, None is also returned when the parent no longer exists.'''
+        parent = self._up()
+        if parent is not None and parent._isCompressed():
+            # Only the last element elided by the compressed parent is created, see _expand()
+            parent._expand(len(parent._items.links) - 1)
+        return self._up()
+    
+    def getRoot(self):
+        '''Returns the top element of the tree containing the element, following the parent pointers.'''
+        result = self
+        while result._up() is not None:
+            result = result._up()
+        return result
+    
+    def numberElements(self):
+        '''Assigns pre-order and post-order numbers to the element and all elements below it, and their depth relative to the element.
+        An element x is below an element y if and only if y._pre < x._pre and x._post < y._post. See isDescendantOf().
+        A tree is numbered when first needed, by getDepth(), isDescendantOf() or getCommonAncestor(), and the numbering is then refreshed
+        by updateWith() and batch edits. The numbers are spaced out, so that the subtree of an updated element can usually be renumbered
+        without renumbering the rest of the tree.'''
+        self._number(0, _NUMBERGAP, 0)
+    
+    def _numbered(self):
+        '''Returns the element, after numbering the tree containing it if the element has not been numbered yet.'''
+        if self._pre is None:
+            self.getRoot().numberElements()
+        return self
+    
+    def _number(self, start, step, depth):
+        '''Numbers the element and the elements below it, starting with pre-order number start and increasing by step,
+        with the element at the given depth.'''
+        count = start
+        stack = [(self, depth, False)]
+        while stack:
+            e, d, done = stack.pop()
+            if done:
+                _setattr(e, '_post', count)
+            else:
+                _setattr(e, '_pre', count)
+                _setattr(e, '_depth', d)
+                stack.append((e, d, True))
+                dd = d + 1 + (len(e._items.links) if e._items.__class__ is _Chain else 0)
+                stack.extend((i, dd, False) for i in reversed(e._storedItems()) if isinstance(i, ParseStruct) and i._items.__class__ is not tuple)
+            count += step
+    
+    def _renumber(self):
+        '''Renumbers the elements below the element after its items have been replaced, within the interval of the element.
+        Renumbers the whole tree if that interval is too small. Does nothing if the element has not been numbered.'''
+        if self._pre is None:
+            return
+        size = sum(1 for _ in self._iterStored())
+        step = (self._post - self._pre) // (2 * size - 1)
+        if step > 0:
+            pre, post = self._pre, self._post
+            self._number(pre, step, self._depth)
+            self._set('_post', post)
+        else:
+            self.getRoot().numberElements()
+    
+    def getSpan(self):
+        '''Returns the tuple (start, end) of the positions of the element in the string it was parsed from, or None if not available.
+        Spans are only kept by parsers created with spans=True, and are dropped for changed elements and their ancestors.
+        The positions are those in the string that was actually parsed, see getParsedString(). Elements introduced by updateWith()
+        have spans relative to the string passed to updateWith(). They are not mapped back to a string that was prepared before
+        parsing, such as the query passed to parseQuery(), which parses prepareQuery(query).'''
+        return self._span[1:] if self._span else None
+    
+    def getParsedString(self):
+        '''Returns the string the element was parsed from, to which its span refers, or None if not available (see getSpan()).'''
+        return self._span[0] if self._span else None
+    
+    def getSource(self):
+        '''Returns the part of the string the element was parsed from that corresponds to the element, including the original
+        whitespace, or None if not available (see getSpan()). Unlike str(), this does not render the element.'''
+        return self._span[0][self._span[1]:self._span[2]] if self._span else None
+    
+    def getDepth(self):
+        '''Returns the depth of the element in its tree (0 for the top element), as determined by numberElements().'''
+        return self._numbered()._depth
+    
+    def isDescendantOf(self, other):
+        '''Returns True if the element lies below other, in constant time once the tree has been numbered (see numberElements()).
+        Both elements must belong to the same tree.'''
+        self._numbered()
+        other._numbered()
+        return other._pre < self._pre and self._post < other._post
+    
+    def isAncestorOf(self, other):
+        '''Returns True if other lies below the element, see isDescendantOf().'''
+        return other.isDescendantOf(self)
+    
+    def getCommonAncestor(self, other):
+        '''Returns the lowest element that is equal to, or an ancestor of, both the element and other. Both elements must belong to the same
+        tree, see isDescendantOf().'''
+        result = self
+        while not (result is other or other.isDescendantOf(result)):
+            result = result.getParent()
+            assert result is not None, 'Elements not in the same tree'
+        return result
     
     def getAncestors(self):
         '''Returns the list of parent nodes, starting with the direct parent and ending with the top element.'''
@@ -229,29 +873,87 @@ class ParseStruct:
             result = result.getItems()[0]
         return result
         
-    def dump(self, indent='', step='|  '):
-        '''Returns a dump of the object, with rich information'''
-        result = ''
-        def dumpString(s, indent, step):
-            return indent + s + '\n'
-        
-        def dumpItems(items, indent, step):
-            result = ''
-            for i in items:
-                if isinstance(i, str):
-                    result += dumpString(i, indent+step, step)
-                else:
-                    assert isinstance(i, ParseStruct) 
-                    result += i.dump(indent+step, step)
-            return result       
-       
-        result += indent + ('> '+ self.getLabel() + ':\n' + indent if self.getLabel() else '') + '[' + self.__class__.__name__ + '] ' + '/' + self.__str__() + '/' + '\n'
-        result += dumpItems(self._items, indent, step)
-        
+    def dump(self, indent='', step='|  ', out=None):
+        '''Returns a dump of the object, with rich information. If out is given, it must be a text stream (e.g. a file or an
+        io.StringIO object). The dump is then written to out piece by piece, and None is returned. The renderings of the elements
+        are written as by render(), without caching them.'''
+        if out is None:
+            out = io.StringIO()
+            self.dump(indent, step, out)
+            return out.getvalue()
+        stack = [(self, indent)]
+        while stack:
+            i, indent = stack.pop()
+            if isinstance(i, str):
+                out.write(indent + i + '\n')
+            else:
+                assert isinstance(i, ParseStruct) 
+                items = i._storedItems()
+                # The elements elided by a compressed element are written from its links, without creating them (see _Chain)
+                for class_, label in ((i.__class__, i._label),) + (items.links if items.__class__ is _Chain else ()):
+                    out.write(indent + ('> '+ label + ':\n' + indent if label else '') + '[' + class_.__name__ + '] ' + '/')
+                    i._writeRendering(out)
+                    out.write('/' + '\n')
+                    indent += step
+                stack.extend((item, indent) for item in reversed(items))
+    
+    def render(self, out=None):
+        '''Prints the rendering of the object, followed by a newline. If out is given, it must be a text stream, to which the
+        rendering is written piece by piece, without building the complete string (or caching it) first.'''
+        if out is None:
+            print(self.__str__())
+            return
+        self._writeRendering(out)
+        out.write('\n')
+    
+    def _writeRendering(self, out):
+        '''Writes the rendering of the element to text stream out piece by piece, using the cached renderings of the elements
+        that have one, but without caching new ones.'''
+        first = True
+        stack = [self]
+        while stack:
+            i = stack.pop()
+            if isinstance(i, ParseStruct) and i._str is None:
+                stack.extend(reversed(i._storedItems()))
+                continue
+            piece = i if isinstance(i, str) else i._str
+            if piece != '':
+                if not first:
+                    out.write(' ')
+                out.write(piece)
+                first = False
+    
+    def getSize(self, recursive=False):
+        '''Returns the approximate memory size in bytes of the element, i.e. of the object itself, its items list, its strings,
+        its label index and its cached rendering. If recursive is True, the sizes of all descendants are included.
+        Strings shared between elements are counted for each element. Elements elided by compressed elements and shared leaves are not counted.'''
+        if recursive:
+            return sum(e.getSize() for e in self._iterStored() if not e._isShared())
+        result = sys.getsizeof(self) + sys.getsizeof(self._items)
+        if self._str is not None:
+            result += sys.getsizeof(self._str)
+        if self._labels is not None:
+            result += sys.getsizeof(self._labels) + sum(sys.getsizeof(v) for v in self._labels.values())
+        for i in self._items:
+            if isinstance(i, str):
+                result += sys.getsizeof(i)
         return result
     
-    def render(self):
-        print(self.__str__())
+    def memoryReport(self):
+        '''Returns a report of the memory used by the element and its descendants. For each class occurring in the tree,
+        the report lists the number of elements, their total size and their average size in bytes (see getSize()).'''
+        counts = {}
+        for e in self._iterStored():
+            if e._isShared():
+                continue
+            count, size = counts.get(e.__class__.__name__, (0, 0))
+            counts[e.__class__.__name__] = (count + 1, size + e.getSize())
+        lines = sorted(counts.items(), key=lambda item: -item[1][1])
+        lines.append(('total', (sum(c for c, _ in counts.values()), sum(s for _, s in counts.values()))))
+        result = '{:<32}{:>8}{:>12}{:>10}\n'.format('class', 'count', 'bytes', 'average')
+        for name, (count, size) in lines:
+            result += '{:<32}{:>8}{:>12}{:>10}\n'.format(name, count, size, size // count)
+        return result
     
     def yieldsValidExpression(self):
         '''Returns True if the rendered expression can be parsed again to an element of the same class.
@@ -268,66 +970,679 @@ class ParseStruct:
         return self == self.__getPattern().parseString(self.__str__())[0]
     
     def hasParentPointers(self):
-        for item in [i for i in self.getItems() if isinstance(i, ParseStruct)]:
-            if not item.getParent() == self or not item.hasParentPointers():
-                return False
-        return True
+        '''Checks whether all elements below the element have their parent pointer set to their parent in the tree.'''
+        return all(i._up() is e for e in self._iterStored() for i in e._storedItems() if isinstance(i, ParseStruct) and not i._isShared())
+    
+# The setters of the attribute slots of ParseStruct, used by ParseStruct.__init__(). Setting a slot through its descriptor bypasses
+# ParseStruct.__setattr__() at less cost than _setattr(), which counts as an element is created for every match of a pattern.
+
+_INITIALIZERS = tuple(ParseStruct.__dict__[att].__set__ for att in _ATTRIBUTES)
+
+class ElementIndex:
+    '''Index of the elements of a parse tree, by class and by label. For each key, the elements are kept in document order
+    (pre-order), as they would be found by a traversal of the tree.
+    The index is built by ParseStruct.buildIndex() and kept up to date by ParseStruct.updateWith() and batch edits.'''
+    
+    def __init__(self, root, elements):
+        '''Indexes elements, which must be the elements of the tree below root, in pre-order.
+        The root holds the index, so the index only holds a weak reference to the root, to avoid a reference cycle. The keys of the root
+        itself are kept in _rootkeys.'''
+        self._root = weakref.ref(root)
+        self._entries = {}
+        self._unsorted = set()
+        self._excluded = set()
+        self._rootkeys = set()
+        for e in elements:
+            if e is root:
+                self._rootkeys.update(self._keys(e))
+                continue
+            for key in self._keys(e):
+                self._entries.setdefault(key, []).append(e)
+    
+    def _keys(self, element):
+        '''Generates the keys for element. Shared leaves are not indexed; their keys are recorded in _excluded instead.'''
+        keys = [('class', element.__class__)] + ([('label', element._label)] if element._label else [])
+        if element._isShared():
+            self._excluded.update(keys)
+            return []
+        return keys
+    
+    def covers(self, *, element_type=None, label=None):
+        '''Returns False if elements with the given class or label may be missing from the index, because they are shared leaves.'''
+        return not ('class', element_type) in self._excluded and not ('label', label) in self._excluded
+    
+    def add(self, elements):
+        '''Adds elements to the index. The order of the affected entries is restored when they are next retrieved.'''
+        for e in elements:
+            for key in self._keys(e):
+                self._entries.setdefault(key, []).append(e)
+                self._unsorted.add(key)
+    
+    def remove(self, elements):
+        '''Removes elements from the index. Elements are matched by identity, not by equality. Keys without entries, such as those of
+        leaves that were shared when the index was built, are skipped.'''
+        removed = {}
+        for e in elements:
+            for key in self._keys(e):
+                removed.setdefault(key, set()).add(id(e))
+        for key, ids in removed.items():
+            entries = self._entries.get(key)
+            if entries:
+                self._entries[key] = [e for e in entries if not id(e) in ids]
+    
+    def getElements(self, *, element_type=None, label=None):
+        '''Returns the list of elements with the given class and/or label, in document order.'''
+        assert element_type or label
+        if element_type:
+            result = self._get(('class', element_type))
+            if label:
+                result = [e for e in result if e._label == label]
+        else:
+            result = self._get(('label', label))
+        return list(result)
+    
+    def _get(self, key):
+        if key in self._unsorted:
+            self._entries[key].sort(key=(lambda e: e._pre) if self._root()._pre is not None else self._path)
+            self._unsorted.discard(key)
+        entries = self._entries.get(key, [])
+        return [self._root()] + entries if key in self._rootkeys else entries
+    
+    def _path(self, element):
+        '''Returns the list of item positions leading from the root to element, which orders elements in document order.'''
+        result = []
+        root = self._root()
+        while element is not root:
+            parent = element._up()
+            result.append(next(i for i, item in enumerate(parent._items) if item is element))
+            element = parent
+        result.reverse()
+        return result
+    
+class BatchEdit:
+    '''A set of replacements of elements in the tree below a given top element, applied together. Each replacement has the effect
+    of updateWith(), but the cached renderings, hashes and the index (if any) are updated only once for all replacements,
+    and validation is done when the replacements are committed, for the replaced elements as updateWith() does. If validation fails,
+    all replacements are undone.
+    Typical use is as a context manager, which commits on normal exit and discards the queued replacements on an exception:
+    
+        with query.batchEdit() as batch:
+            for elt in query.searchElements(element_type=SPARQLParser.iri):
+                batch.replace(elt, newvalue(elt))'''
+    
+    def __init__(self, top, *, validation=None):
+        self._top = top
+        self._validation = _validationLevel(top.__class__, validation)
+        self._edits = []
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+    
+    def replace(self, element, new_content):
+        '''Queues the replacement of the items of element by those of new_content, a string that is parsed immediately.
+        Raises a ParsertoolsException if new_content is not valid for the element.'''
+        if element._isShared():
+            raise ParsertoolsException('Shared leaf element {} cannot be changed'.format(element.__class__.__name__))
+        if self._validation != 'off':
+            assert element is self._top or any(a is self._top for a in element.getAncestors()), 'Element {} not in tree'.format(element)
+        self._edits.append((element, element._parseContent(new_content)))
+    
+    def rollback(self):
+        '''Discards the queued replacements.'''
+        self._edits = []
+    
+    def commit(self):
+        '''Applies the queued replacements and validates the result. Raises a ParsertoolsException, leaving the tree unchanged,
+        if two replacements overlap or if the result is not valid.'''
+        edits, self._edits = self._edits, []
+        if not edits:
+            return
+        elements = dict((id(e), e) for e, _ in edits)
+        if len(elements) < len(edits) or any(id(a) in elements for e, _ in edits for a in e.getAncestors()):
+            raise ParsertoolsException('Overlapping replacements in batch edit')
+        olditems = [(e, e.getItems()) for e, _ in edits]
+        self._apply(edits)
+        try:
+            if self._validation == 'full':
+                valid = all(e.isValid() for e, _ in edits)
+            elif self._validation == 'cheap':
+                valid = all(c._up() is e for e, _ in edits for c in e.getChildren())
+            else:
+                valid = True
+        except ParseException:
+            valid = False
+        except Exception:
+            self._apply(olditems)
+            raise
+        if not valid:
+            self._apply(olditems)
+            raise ParsertoolsException('Batch edit of {} gives invalid result'.format(self._top.__class__.__name__))
+    
+    def _apply(self, edits):
+        '''Sets the items for each (element, items) pair in edits, and updates parent pointers, label indexes, cached renderings,
+        hashes and the index.'''
+        # The indexes covering each edited element, with the edited elements they cover
+        indexes = {}
+        for e, _ in edits:
+            for index in e._indexes():
+                indexes.setdefault(id(index), (index, []))[1].append(e)
+        for index, elements in indexes.values():
+            index.remove([d for e in elements for d in list(e._iterIndexed())[1:]])
+        if _lazyCopies:
+            for e, _ in edits:
+                e._completeLazyCopies()
+        dirty = {}
+        for e, items in edits:
+            e._set('_items', items)
+            e._linkItems()
+            e._renumber()
+            elt = e
+            while elt is not None and not id(elt) in dirty:
+                dirty[id(elt)] = elt
+                elt = elt.getParent()
+        # Clear the caches of the changed elements and their ancestors, once each
+        for elt in dirty.values():
+            elt._set('_str', None)
+            elt._set('_span', None)
+            elt._set('_hash', None)
+        for index, elements in indexes.values():
+            index.add([d for e in elements for d in list(e._iterIndexed())[1:]])
+    
+# The characters matched by the escapes for character categories in regular expressions (in their ASCII range), and by the
+# other escapes of a single character
+_CATEGORIES = {'d': string.digits, 'w': string.ascii_letters + string.digits + '_', 's': ' \t\n\r\f\v'}
+_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'f': '\f', 'v': '\v', 'a': '\a'}
+_HEXDIGITS = {'x': 2, 'u': 4, 'U': 8}
+
+def _firstChars(regex):
+    '''Returns the ASCII characters a match of the compiled regular expression regex can start with, and whether it can start with
+    a non-ASCII character, as a tuple (set, bool). Returns None if this cannot be determined, or if regex can match the empty string.
+    The source of regex is scanned for this; constructs other than characters, escapes, character classes, groups, alternatives,
+    anchors, lookarounds and repetitions make the result undetermined.'''
+    if regex.flags & (re.IGNORECASE | re.VERBOSE) or not isinstance(regex.pattern, str):
+        return None
+    source = regex.pattern
+    pos = 0
+    
+    def char(inClass):
+        '''Reads a character or an escape, and returns the code point of the character, or the name of a category escape.'''
+        nonlocal pos
+        c = source[pos]
+        pos += 1
+        if c != '\\':
+            return ord(c)
+        c = source[pos]
+        pos += 1
+        if c in _HEXDIGITS:
+            pos += _HEXDIGITS[c]
+            return int(source[pos - _HEXDIGITS[c]:pos], 16)
+        if c in _CATEGORIES:
+            return c
+        if c in _ESCAPES or (c == 'b' and inClass):
+            return ord(_ESCAPES.get(c, '\b'))
+        if c.isalnum():
+            raise ValueError(c)
+        return ord(c)
+    
+    def charClass():
+        '''Reads a character class after its opening bracket, and returns (chars, nonAscii).'''
+        nonlocal pos
+        negate = source[pos] == '^'
+        pos += negate
+        chars, nonAscii, first = set(), False, True
+        while source[pos] != ']' or first:
+            first = False
+            low = char(True)
+            if low in _CATEGORIES:
+                chars.update(_CATEGORIES[low])
+                nonAscii = True
+                continue
+            high = low
+            if source[pos] == '-' and source[pos + 1] != ']':
+                pos += 1
+                high = char(True)
+                if high in _CATEGORIES:
+                    raise ValueError(high)
+            chars.update(chr(c) for c in range(low, min(high, 127) + 1))
+            nonAscii = nonAscii or high >= 128
+        pos += 1
+        if negate:
+            return set(chr(c) for c in range(128)) - chars, True
+        return chars, nonAscii
+    
+    def item():
+        '''Reads an item with its repetition, if any, and returns (chars, nonAscii, nullable).'''
+        nonlocal pos
+        c = source[pos]
+        if c == '(':
+            pos += 1
+            zeroWidth = False
+            if source[pos] == '?':
+                for prefix in ('?:', '?=', '?!', '?<=', '?<!', '?P<'):
+                    if source.startswith(prefix, pos):
+                        break
+                else:
+                    raise ValueError(source[pos:])
+                zeroWidth = prefix not in ('?:', '?P<')
+                pos = source.index('>', pos) + 1 if prefix == '?P<' else pos + len(prefix)
+            result = alternatives()
+            pos += 1
+            if zeroWidth:
+                # Lookarounds match the empty string; skipping them gives a superset of the first characters
+                result = (set(), False, True)
+        elif c == '[':
+            pos += 1
+            result = charClass() + (False,)
+        elif c in '^$':
+            pos += 1
+            result = (set(), False, True)
+        elif c == '.':
+            pos += 1
+            result = (set(chr(c) for c in range(128)) - {'\n'}, True, False)
+        elif c in '*+?{|)':
+            raise ValueError(c)
+        elif source.startswith(('\\b', '\\B', '\\A', '\\Z'), pos):
+            pos += 2
+            result = (set(), False, True)
+        else:
+            c = char(False)
+            if c in _CATEGORIES:
+                result = (set(_CATEGORIES[c]), True, False)
+            else:
+                result = ({chr(c)} if c < 128 else set(), c >= 128, False)
+        if pos < len(source) and source[pos] in '*?+{':
+            if source[pos] == '{':
+                end = source.index('}', pos)
+                low = source[pos + 1:end].split(',')[0]
+                optional = not low or int(low) == 0
+                pos = end + 1
+            else:
+                optional = source[pos] != '+'
+                pos += 1
+            if pos < len(source) and source[pos] in '?+':
+                # Lazy or possessive repetition
+                pos += 1
+            result = result[:2] + (result[2] or optional,)
+        return result
+    
+    def alternatives():
+        '''Reads alternatives up to a closing parenthesis or the end of the source, and returns (chars, nonAscii, nullable).'''
+        nonlocal pos
+        chars, nonAscii, nullable = set(), False, False
+        while True:
+            # The first characters of a sequence are those of its items up to the first one that cannot match the empty string
+            sequenceNullable = True
+            while pos < len(source) and source[pos] not in '|)':
+                first = item()
+                if sequenceNullable:
+                    chars |= first[0]
+                    nonAscii = nonAscii or first[1]
+                    sequenceNullable = first[2]
+            nullable = nullable or sequenceNullable
+            if pos == len(source) or source[pos] == ')':
+                return chars, nonAscii, nullable
+            pos += 1
+    
+    try:
+        result = alternatives()
+    except (ValueError, IndexError):
+        return None
+    if pos < len(source) or result[2]:
+        return None
+    return result[0], result[1]
+
+def _firstSet(pattern, memo):
+    '''Returns what a match of pattern can start with, as a tuple (chars, nonAscii, words, nullable): the ASCII characters, whether it
+    can start with a non-ASCII character, the keywords as tuples (length, caseless, keyword), and whether it can match the empty
+    string. Returns None if this cannot be determined. The result is a superset: a match of pattern at a position (after whitespace)
+    starts with one of the characters or keywords, or is empty. memo caches results by id(pattern).'''
+    key = id(pattern)
+    if key in memo:
+        # None while in progress, so that recursive patterns are undetermined
+        return memo[key]
+    memo[key] = None
+    if pattern.ignoreExprs or set(pattern.whiteChars) != set(ParserElement.DEFAULT_WHITE_CHARS):
+        return None
+    if not pattern.skipWhitespace and not isinstance(pattern, MatchFirst) and \
+            not (isinstance(pattern, And) and pattern.exprs and type(pattern.exprs[0]) is Empty):
+        # Alternatives skip whitespace themselves, and so does what follows a leading Empty in a sequence
+        return None
+    result = None
+    if isinstance(pattern, Empty):
+        result = (frozenset(), False, frozenset(), True)
+    elif isinstance(pattern, Keyword):
+        result = (frozenset(), False, frozenset({(pattern.matchLen, pattern.caseless, pattern.caselessmatch if pattern.caseless else pattern.match)}), False)
+    elif isinstance(pattern, Literal) and not isinstance(pattern, CaselessLiteral) and pattern.match:
+        first = pattern.match[0]
+        result = (frozenset({first}) if first < '\x80' else frozenset(), first > '\x7f', frozenset(), False)
+    elif isinstance(pattern, Regex):
+        first = _firstChars(pattern.re)
+        if first is not None:
+            result = (frozenset(first[0]), first[1], frozenset(), False)
+    elif isinstance(pattern, (NotAny, FollowedBy, PrecededBy)):
+        result = (frozenset(), False, frozenset(), True)
+    elif isinstance(pattern, (Optional, ZeroOrMore, OneOrMore, Group, Combine, Suppress, Forward)):
+        if pattern.expr is not None:
+            result = _firstSet(pattern.expr, memo)
+            if result is not None and isinstance(pattern, (Optional, ZeroOrMore)):
+                result = result[:3] + (True,)
+    elif isinstance(pattern, (And, MatchFirst, Or)):
+        chars, nonAscii, words, nullable = set(), False, set(), isinstance(pattern, And)
+        for e in pattern.exprs:
+            first = _firstSet(e, memo)
+            if first is None:
+                return None
+            chars |= first[0]
+            nonAscii = nonAscii or first[1]
+            words |= first[2]
+            if isinstance(pattern, And):
+                if not first[3]:
+                    nullable = False
+                    break
+            else:
+                nullable = nullable or first[3]
+        result = (frozenset(chars), nonAscii, frozenset(words), nullable)
+    memo[key] = result
+    return result
+
+class Dispatcher:
+    '''First-token dispatch for the alternations (MatchFirst patterns) of the grammar of a parser. For each alternation with at least
+    minAlternatives alternatives, the characters and keywords its alternatives can start with are determined (see _firstSet()).
+    When an alternation is tried at a position, only the alternatives that can start with the character or keyword found there are
+    tried, in their original order; for keyword-led alternatives such as those of BuiltInCall, this is usually a single one.
+    Alternatives for which this cannot be determined, or that can match the empty string, are always tried.
+    Creating a Dispatcher installs the dispatch in the alternations for good, by making them _DispatchingMatchFirst patterns. The
+    parser modules create one for their parser when its grammar is complete, and keep it as the dispatcher attribute of the parser;
+    a Dispatcher must only be created after the elements it is created for have been added to the parser. As the alternations only
+    read their tables while parsing, parses running concurrently in different threads can use them. The results of a parse are the
+    same as without dispatch; only the position reported in the exception for a failed parse may differ.'''
+    
+    def __init__(self, parser, start=None, minAlternatives=4):
+        '''The alternations are collected from the patterns of the element classes in start, or of all element classes of parser if
+        start is None.'''
+        if start is None:
+            start = [c for c in vars(parser).values() if isinstance(c, type) and issubclass(c, ParseStruct) and getattr(c, '_pattern', None) is not None]
+        self._start = [c._pattern for c in start]
+        for p in self._start:
+            # Nested alternations are flattened by streamlining, which parsing would otherwise do on first use
+            p.streamline()
+        self.minAlternatives = minAlternatives
+        self._build()
+        for p, table in self._tables.values():
+            p._dispatch = (table, len(p.exprs))
+            p.__class__ = _DispatchingMatchFirst
+        
+    def _build(self):
+        '''Collects the alternations and computes their dispatch tables.'''
+        self._tables = {}
+        memo = {}
+        seen = set()
+        stack = list(reversed(self._start))
+        while stack:
+            p = stack.pop()
+            if id(p) in seen:
+                continue
+            seen.add(id(p))
+            if type(p) in (MatchFirst, _DispatchingMatchFirst) and len(p.exprs) >= self.minAlternatives:
+                table = self._table(p, memo)
+                if table is not None:
+                    self._tables[id(p)] = (p, table)
+            stack.extend(reversed(getattr(p, 'exprs', [])))
+            if isinstance(getattr(p, 'expr', None), ParserElement):
+                stack.append(p.expr)
+        
+    @staticmethod
+    def _table(pattern, memo):
+        '''Returns the dispatch table for the alternation pattern, as a tuple (byChar, nonAscii, byWord, keywordLengths, always).
+        The first three map to lists of (position, alternative), always is such a list. Returns None if no alternative can be
+        dispatched on.'''
+        byChar, nonAscii, byWord, always = {}, [], {}, []
+        for alternative in enumerate(pattern.exprs):
+            first = _firstSet(alternative[1], memo)
+            if first is None or first[3]:
+                always.append(alternative)
+                continue
+            for c in first[0]:
+                byChar.setdefault(c, []).append(alternative)
+            if first[1]:
+                nonAscii.append(alternative)
+            for word in first[2]:
+                byWord.setdefault(word[:2], {}).setdefault(word[2], []).append(alternative)
+        if len(always) == len(pattern.exprs):
+            return None
+        for c in byChar:
+            byChar[c] = sorted(byChar[c] + always, key=lambda a: a[0])
+        nonAscii = sorted(nonAscii + always, key=lambda a: a[0])
+        return byChar, nonAscii, byWord, sorted(byWord), always
+
+class _DispatchingMatchFirst(MatchFirst):
+    '''An alternation in which a Dispatcher has installed dispatch. Its _dispatch attribute holds the dispatch table (see
+    Dispatcher._table()) and the number of alternatives it was computed for. The table refers to the alternatives by position, so
+    that copies of the pattern, which have copies of the alternatives, use their own. The alternation tries all its alternatives,
+    as a MatchFirst does, if expressions to be ignored have been added to it (see ParserElement.ignore()), as they may precede the
+    first character, or if its alternatives have changed in number since the table was computed.'''
+    
+    def parseImpl(self, instring, loc, doActions=True):
+        table, count = self._dispatch
+        exprs = self.exprs
+        if self.ignoreExprs or len(exprs) != count:
+            return MatchFirst.parseImpl(self, instring, loc, doActions)
+        byChar, nonAscii, byWord, keywordLengths, always = table
+        whiteChars = ParserElement.DEFAULT_WHITE_CHARS
+        start = loc
+        while start < len(instring) and instring[start] in whiteChars:
+            start += 1
+        c = instring[start:start + 1]
+        alternatives = nonAscii if c > '\x7f' else byChar.get(c, always)
+        for n, caseless in keywordLengths:
+            word = instring[start:start + n]
+            found = byWord[(n, caseless)].get(word.upper() if caseless else word)
+            if found:
+                alternatives = sorted(set(alternatives).union(found), key=lambda a: a[0])
+        maxException = None
+        for position, _ in alternatives:
+            e = exprs[position]
+            try:
+                return e._parse(instring, loc, doActions)
+            except ParseFatalException:
+                raise
+            except ParseException as err:
+                if maxException is None or err.loc > maxException.loc:
+                    maxException = err
+            except IndexError:
+                if maxException is None or len(instring) > maxException.loc:
+                    maxException = ParseException(instring, len(instring), e.errmsg, self)
+        if maxException is not None and maxException.loc > start:
+            raise maxException
+        raise ParseException(instring, start, self.errmsg, self)
+
+def _parse(class_, text):
+    '''Parses text with the _pattern of class_, and returns the result. If the parser of class_ has a compiled parser module (see
+    generator.generateParser()), the module parses instead.
+    If the parser was created with pauseGC=True, the cyclic garbage collector is suspended while parsing,
+    and the gcStats attribute of the parser is set to a dict with the duration of the parse in seconds ('seconds'), the increase in the
+    number of objects tracked by the collector ('objects'), and the collection counts of the collector after the parse ('counts',
+    see gc.get_count()).'''
+    parser = class_._parser
+    compiled = parser.compiled if parser else None
+    parse = compiled.parse if compiled is not None else _parseString
+    if not (parser and parser.pauseGC):
+        return parse(class_, text)
+    enabled = gc.isenabled()
+    gc.disable()
+    objects = gc.get_count()[0]
+    start = time.perf_counter()
+    try:
+        return parse(class_, text)
+    finally:
+        parser.gcStats = {'seconds': time.perf_counter() - start, 'objects': gc.get_count()[0] - objects, 'counts': gc.get_count()}
+        if enabled:
+            gc.enable()
+
+def _parseString(class_, text):
+    '''Parses text with the _pattern of class_, and returns the result.'''
+    return class_._pattern.parseString(text, parseAll=True)[0]
+
+def freezeTrees():
+    '''Collects garbage, and then moves all objects tracked by the garbage collector, such as cached parse trees, to a permanent
+    generation that is ignored by future collections (see gc.freeze()). This applies to all objects, not only to parse trees.'''
+    gc.collect()
+    gc.freeze()
+    
+def unfreezeTrees():
+    '''Returns the objects frozen by freezeTrees() to the oldest generation of the garbage collector (see gc.unfreeze()).'''
+    gc.unfreeze()
+
+class InternTable:
+    '''Table of strings, used by a parser to share the strings in the items of parsed elements (IRIs, prefixes, variable names,
+    keywords, etc.) within and between parse trees. Strings taken from the table compare by identity first.
+    If maxsize is given, the table holds at most maxsize strings; when it is full, the string added first is dropped.
+    Strings dropped from the table remain valid, but are no longer shared with strings added later.
+    A table is set for a parser with its internTable argument or attribute.'''
+    
+    def __init__(self, maxsize=None):
+        assert maxsize is None or maxsize > 0
+        self._maxsize = maxsize
+        self._strings = {}
+        
+    def __len__(self):
+        return len(self._strings)
     
+    def intern(self, s):
+        '''Returns the string in the table that is equal to s, after adding s to the table if there is none.'''
+        result = self._strings.get(s)
+        if result is None:
+            if self._maxsize is not None and len(self._strings) >= self._maxsize:
+                del self._strings[next(iter(self._strings))]
+            self._strings[s] = result = s
+        return result
+    
+    def clear(self):
+        '''Removes all strings from the table.'''
+        self._strings.clear()
+
 def parseStructFunc(class_):
     '''Returns the function that converts a ParseResults object to a ParseStruct object of class "class_", with label set to None, and
     items set to a recursive list of objects, each of which is either a string or a further ParseStruct object.
-    The function returned is used to set a parseAction for a _pattern.'''
+    The function returned is used to set a parseAction for a _pattern.
+    The checks done while converting depend on the validation level of the parser for class_.
+    If the parser was created with collapse=True, chains of elements with a single item are compressed, see _Chain.
+    If it was created with shareLeaves=True, the function returns a shared leaf for a fixed-text class, see _sharedLeaf().
+    If the parser has an internTable (see InternTable), the strings in the items are taken from it.'''
             
-    def itemList(parseresults):
+    def itemList(parseresults, validation, table):
         '''For internal use. Converts a ParseResults object to a recursive structure consisting of a list of objects,
-        which will serve as the items attribute of a ParseStruct object.'''
+        which will serve as the items attribute of a ParseStruct object. A shared leaf that gets a label is replaced by the shared leaf
+        with that label, see _sharedLeaf(). If table is not None, strings are interned in it.'''
         
         while len(parseresults) == 1 and isinstance(parseresults[0], ParseResults):
             parseresults = parseresults[0]
-        valuedict = dict((id(t), k) for (k, t) in parseresults.items())
-        assert len(valuedict) == len(list(parseresults.items())), 'internal error: len(valuedict) = {}, len(parseresults.items) = {}'.format(len(valuedict), len(list(parseresults.items)))
+        valuedict = dict((id(t), k) for (k, t) in parseresults.items()) if parseresults.haskeys() else {}
+        if validation == 'full' and valuedict:
+            assert len(valuedict) == len(list(parseresults.items())), 'internal error: len(valuedict) = {}, len(parseresults.items) = {}'.format(len(valuedict), len(list(parseresults.items)))
         result = []
         for t in parseresults:
             if isinstance(t, str):
-                result.append(t)
+                result.append(table.intern(t) if table is not None else t)
             elif isinstance(t, ParseStruct):
-                if t.__dict__['_label'] == None:
-                    t.__dict__['_label'] = valuedict.get(id(t))
+                label = valuedict.get(id(t)) if valuedict else None
+                if label is not None and t._label is None:
+                    if t._items.__class__ is tuple:
+                        if validation != 'off':
+                            assert sum(1 for u in parseresults if u is t) == 1, 'Cannot label shared leaf {} occurring more than once'.format(t)
+                        t = _sharedLeaf(t.__class__, t._items[0], label)
+                    else:
+                        _setattr(t, '_label', label)
                 result.append(t)
             elif isinstance(t, list):
                 result.append(t)
             else:
                 assert isinstance(t, ParseResults), type(t)
-                assert valuedict.get(id(t)) == None, 'Error: found label ({}) for compound expression {}'.format(valuedict.get(id(t)), t.__str__())
-                result.extend(itemList(t))
+                if validation == 'full':
+                    assert valuedict.get(id(t)) == None, 'Error: found label ({}) for compound expression {}'.format(valuedict.get(id(t)), t.__str__())
+                result.extend(itemList(t, validation, table))
         return result
     
-    def makeparseinfo(parseresults):
-        # The function to be returned.
-        assert issubclass(class_, ParseStruct)
-        assert isinstance(parseresults, ParseResults)
+    def makeparseinfo(source, loc, parseresults):
+        # The function to be returned. With none of the options of the parser set, the element is built directly, as a new element
+        # needs no invalidation (see setItems()).
+        parser = class_._parser
+        validation = parser.validation if parser else 'full'
+        if validation != 'off':
+            assert issubclass(class_, ParseStruct)
+            assert isinstance(parseresults, ParseResults)
+        if parser is None or not (parser.shareLeaves or parser.spans or parser.collapse):
+            result = class_(None)
+            _setattr(result, '_items', itemList(parseresults, validation, parser.internTable if parser else None))
+            result._linkItems()
+            return result
+        table = parser.internTable
+        if parser.shareLeaves and _isFixedText(class_):
+            return _sharedLeaf(class_, parseresults[0], None)
+        items = itemList(parseresults, validation, table)
         result = class_(None)
-        result.setItems(itemList(parseresults))
+        _setattr(result, '_items', items)
+        if parser.spans:
+            _setattr(result, '_span', _span(source, loc, items))
+        # A compressed element links the items it takes over itself, see _collapse()
+        if parser.collapse and len(items) == 1 and isinstance(items[0], ParseStruct):
+            result._collapse()
+        else:
+            result._linkItems()
         return result
     
     return makeparseinfo
 
+def _span(source, loc, items):
+    '''Returns the span (source, start, end) of items, which were parsed from source starting at position loc (possibly followed by
+    whitespace), or None if it cannot be determined. The end positions of subelements are taken from their spans; strings are matched
+    against source, skipping whitespace.'''
+    while loc < len(source) and source[loc].isspace():
+        loc += 1
+    pos = loc
+    for i in items:
+        if not isinstance(i, str) and i._items.__class__ is tuple:
+            i = i._items[0]
+        if isinstance(i, ParseStruct):
+            if i._span is None or not i._span[0] is source:
+                return None
+            pos = i._span[2]
+        else:
+            while pos < len(source) and source[pos].isspace():
+                pos += 1
+            if source[pos:pos + len(i)].lower() != i.lower():
+                return None
+            pos += len(i)
+    return (source, loc, pos)
+
 # Helper function for delimited lists where the delimiters must be included in the result
 
 def separatedList(_pattern, sep=','):
     '''Similar to a delimited list of instances from a ParseStruct subclass, but includes the separator in its ParseResults. Returns a 
     delimitedList object with a special parse action. If a resultsName for the delimitedList was specified, the corresponding
-    label is applied to all occurrences of the _pattern.'''
+    label is applied to all occurrences of the _pattern.
+    The checks done while converting depend on the validation level of the parser for the _pattern.'''
       
     def makeList(parseresults):
         assert len(parseresults) > 0, 'internal error'
         assert len(list((parseresults.keys()))) <= 1, 'internal error, got more than one key: {}'.format(list(parseresults.keys()))
         label = list(parseresults.keys())[0] if len(list(parseresults.keys())) == 1 else None
-        assert all([p.__class__._pattern == _pattern for p in parseresults if isinstance(p, ParseStruct)]), 'internal error: _pattern mismatch ({}, {})'.format(p.__class__._pattern, _pattern)
+        if _validationLevel(parseresults[0].__class__ if isinstance(parseresults[0], ParseStruct) else ParseStruct) == 'full':
+            assert all([p.__class__._pattern == _pattern for p in parseresults if isinstance(p, ParseStruct)]), 'internal error: _pattern mismatch ({}, {})'.format(p.__class__._pattern, _pattern)
         templist = []
         for item in parseresults:
             if isinstance(item, ParseStruct):
-                item.__dict__['_label'] = label
+                if item._items.__class__ is tuple:
+                    item = _sharedLeaf(item.__class__, item._items[0], label)
+                else:
+                    item._set('_label', label)
                 templist.append(item)
             else:
                 assert isinstance(item, str)
@@ -0,0 +1,467 @@
+'''
+Generation of recursive-descent parser modules for parsers defined with base.py (see the Parser class in the parser definition files).
+
+generateParser() writes the source of a Python module with one function per pattern of the grammar of a parser. Terminals are
+matched with inlined code, whitespace is skipped with a single regular expression match, and alternations dispatch on the first
+character or keyword of their alternatives (see base.Dispatcher), with the tables computed when the module is generated. Failures
+are returned as None instead of raised as exceptions. The functions build the same ParseResults as the pyparsing patterns, and
+call the same parse actions, so that the parse produces the same ParseStruct trees.
+
+The generated module does not import the parser definition module. Its parse() function is used for the parses of a parser when
+the module is set as its compiled attribute (see base._parse()). On its first parse for a parser, the module takes the parse actions
+and the patterns that it calls from the grammar of the parser, after checking that the grammar is the one it was generated from
+(see grammarFingerprint()). Failed parses raise a ParseException, whose location is the end of the longest match of the element that
+was found, which need not be the location pyparsing reports. Grammars to which expressions to be ignored have been added (see
+ParserElement.ignore()), and left recursion (see ParserElement.enable_left_recursion()), are not supported: parse() raises a
+ParsertoolsException for them, as it does for element classes that are not in the grammar. The generated code runs with every
+version of pyparsing that parsertools supports, but the fingerprint depends on the version of pyparsing, as versions of pyparsing
+build the patterns of a grammar differently (the SPARQLParser grammar has a different fingerprint with pyparsing 2.4, 3.0 and 3.3).
+A module must therefore be generated with the version of pyparsing it is used with. It records that version in PYPARSING_VERSION,
+and names it in the exception raised for a grammar that does not match. loadParser() generates and imports such a module without
+writing it to a file.
+
+The generated modules import grammarPatterns() and grammarFingerprint() from this module. These functions are public, and their
+results for a grammar do not change between releases of parsertools, so that a generated module keeps working until the grammar,
+or the version of pyparsing, changes.
+'''
+import io
+import re
+import types
+import hashlib
+import pyparsing
+from pyparsing import *
+from parsertools import ParsertoolsException
+from parsertools.base import ParseStruct, Dispatcher, _DispatchingMatchFirst
+
+_SingleCharLiteral = type(Literal('x'))
+_DelimitedList = getattr(pyparsing, 'DelimitedList', None)
+_optionalNotMatched = getattr(Optional, '_{}__optionalNotMatched'.format(Optional.__name__), None)
+
+def grammarPatterns(parser):
+    '''Returns the element classes of parser with a pattern, as a list of (name, position) with the position of the pattern in
+    the list of patterns of the grammar, and that list. The patterns are streamlined, and listed in depth first order.
+    Generated modules use this function to find the patterns of a grammar.'''
+    classes = [c for c in vars(parser).values() if isinstance(c, type) and issubclass(c, ParseStruct) and getattr(c, '_pattern', None) is not None]
+    for c in classes:
+        c._pattern.streamline()
+    positions = {}
+    nodes = []
+    for c in classes:
+        stack = [c._pattern]
+        while stack:
+            p = stack.pop()
+            if id(p) in positions:
+                continue
+            positions[id(p)] = len(nodes)
+            nodes.append(p)
+            if isinstance(getattr(p, 'expr', None), ParserElement):
+                stack.append(p.expr)
+            stack.extend(reversed(getattr(p, 'exprs', [])))
+    return [(c.__name__, positions[id(c._pattern)]) for c in classes], nodes
+
+def _kind(pattern):
+    '''Returns the kind of code generated for pattern, or None if it is parsed by calling the pattern itself.'''
+    if pattern.debug or pattern.failAction or any(m in vars(pattern) for m in ('parseImpl', 'postParse', 'preParse', '_parse')):
+        return None
+    t = type(pattern)
+    if t in (Literal, _SingleCharLiteral):
+        return 'literal'
+    elif t in (Keyword, CaselessKeyword):
+        return 'keyword'
+    elif t is Regex:
+        return 'regex'
+    elif t is Empty:
+        return 'empty'
+    elif t is And:
+        return None if any(isinstance(e, And._ErrorStop) for e in pattern.exprs) else 'and'
+    elif t in (MatchFirst, _DispatchingMatchFirst):
+        return 'first' if pattern.exprs else None
+    elif t is Optional:
+        return 'opt'
+    elif t in (ZeroOrMore, OneOrMore):
+        return 'more' if pattern.not_ender is None and getattr(pattern, 'max_count', None) is None else None
+    elif t is NotAny:
+        return 'not'
+    elif t in (Group, Suppress, Combine, Forward, _DelimitedList):
+        return 'enhance' if pattern.expr is not None else None
+    return None
+
+def grammarFingerprint(nodes):
+    '''Returns a digest of the properties of the patterns in nodes, as returned by grammarPatterns(), that the generated code depends
+    on. Generated modules compare it with the fingerprint they were generated for. The digest is computed from the patterns only, but
+    as versions of pyparsing build the patterns of a grammar differently, the fingerprint of a grammar depends on the version of
+    pyparsing.'''
+    positions = {id(p): n for n, p in enumerate(nodes)}
+    h = hashlib.sha1()
+    for p in nodes:
+        children = list(getattr(p, 'exprs', []))
+        if isinstance(getattr(p, 'expr', None), ParserElement):
+            children.append(p.expr)
+        name = 'MatchFirst' if type(p) is _DispatchingMatchFirst else type(p).__name__
+        h.update(repr((name, _kind(p), [positions.get(id(e)) for e in children], p.resultsName, p.saveAsList, p.modalResults,
+                       p.skipWhitespace, p.callPreparse, ''.join(sorted(p.whiteChars)), len(p.parseAction), p.callDuringTry, p.keepTabs,
+                       getattr(p, 'match', None), getattr(p, 'caseless', None), getattr(p, 'pattern', None), getattr(p, 'flags', None),
+                       getattr(p, '_asPythonList', False), getattr(p, 'defaultValue', None) is _optionalNotMatched)).encode())
+    return h.hexdigest()
+
+class _Writer:
+    '''The source of a generated module, and the names of the values it binds from the grammar.'''
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.positions = {id(p): n for n, p in enumerate(nodes)}
+        self.lines = []
+        self.bindings = []
+        self.whites = {}
+        self.tables = []
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def bind(self, name, expression):
+        '''Returns name, bound at import to the value of expression, in which _N is the list of patterns of the grammar.'''
+        if (name, expression) not in self.bindings:
+            self.bindings.append((name, expression))
+        return name
+
+    def white(self, chars):
+        '''Returns the name of the function that skips the characters in chars.'''
+        chars = ''.join(sorted(chars))
+        if chars not in self.whites:
+            self.whites[chars] = '_w{}'.format(len(self.whites))
+        return self.whites[chars]
+
+    def position(self, pattern):
+        return self.positions[id(pattern)]
+
+    def call(self, pattern, preParse=True):
+        '''Returns the name of the function that parses pattern, with or without skipping what precedes it.'''
+        return '_{}{}'.format('e' if preParse else 'p', self.position(pattern))
+
+def _skip(w, pattern, indent):
+    '''Writes the code that skips what precedes pattern.'''
+    if pattern.callPreparse and pattern.skipWhitespace and pattern.whiteChars:
+        w.emit(indent, 'loc = {}(s, loc).end()'.format(w.white(pattern.whiteChars)))
+
+def _results(w, pattern, indent):
+    '''Writes the code that returns the results of pattern for the tokens t, which end at end and start at loc.'''
+    n = w.position(pattern)
+    if pattern.resultsName is None and pattern.modalResults:
+        w.emit(indent, 'toks = _PR(t)')
+    else:
+        w.emit(indent, 'toks = _named(t, {!r}, {!r}, {!r})'.format(pattern.resultsName, pattern.saveAsList, pattern.modalResults))
+    if pattern.parseAction:
+        w.emit(indent, 'try:')
+        for k in range(len(pattern.parseAction)):
+            action = w.bind('_a{}_{}'.format(n, k), '_N[{}].parseAction[{}]'.format(n, k))
+            w.emit(indent + 1, 'r = {}(s, loc, toks)'.format(action))
+            w.emit(indent + 1, 'if r is not None and r is not toks:')
+            aslist = 'isinstance(r, (_PR, list))' if pattern.saveAsList else 'False'
+            w.emit(indent + 2, 'toks = _named(r, {!r}, {}, {!r})'.format(pattern.resultsName, aslist, pattern.modalResults))
+        w.emit(indent, 'except (ParseException, IndexError):')
+        w.emit(indent + 1, 'return None')
+    w.emit(indent, 'return end, toks')
+
+def _terminal(w, pattern, kind, indent):
+    '''Writes the code that matches the terminal pattern at loc.'''
+    n = w.position(pattern)
+    if kind == 'literal':
+        w.emit(indent, 'if not s.startswith({!r}, loc):'.format(pattern.match))
+        w.emit(indent + 1, 'return None')
+        w.emit(indent, 'end = loc + {}'.format(len(pattern.match)))
+        w.emit(indent, 't = {!r}'.format(pattern.match))
+    elif kind == 'keyword':
+        identChars = w.bind('_i{}'.format(n), '_N[{}].identChars'.format(n))
+        w.emit(indent, 'end = loc + {}'.format(pattern.matchLen))
+        if pattern.caseless:
+            w.emit(indent, 'if s[loc:end].upper() != {!r} or loc and s[loc - 1].upper() in {i} or end < len(s) and s[end].upper() in {i}:'.format(
+                pattern.caselessmatch, i=identChars))
+        else:
+            w.emit(indent, 'if not s.startswith({!r}, loc) or loc and s[loc - 1] in {i} or end < len(s) and s[end] in {i}:'.format(
+                pattern.match, i=identChars))
+        w.emit(indent + 1, 'return None')
+        w.emit(indent, 't = {!r}'.format(pattern.match))
+    elif kind == 'regex':
+        match = w.bind('_r{}'.format(n), '_N[{}].re.match'.format(n))
+        w.emit(indent, 'm = {}(s, loc)'.format(match))
+        w.emit(indent, 'if m is None:')
+        w.emit(indent + 1, 'return None')
+        w.emit(indent, 'end = m.end()')
+        if pattern.re.groupindex:
+            w.emit(indent, 't = _PR(m[0])')
+            w.emit(indent, 'for k, v in m.groupdict().items():')
+            w.emit(indent + 1, 't[k] = v')
+        else:
+            w.emit(indent, 't = m[0]')
+    else:
+        w.emit(indent, 'end = loc')
+        w.emit(indent, 't = []')
+    _results(w, pattern, indent)
+
+def _sequence(w, pattern, indent):
+    '''Writes the code that parses the sequence pattern at loc.'''
+    w.emit(indent, 'r = {}(s, loc)'.format(w.call(pattern.exprs[0], False)))
+    w.emit(indent, 'if r is None:')
+    w.emit(indent + 1, 'return None')
+    w.emit(indent, 'end, t = r')
+    for e in pattern.exprs[1:]:
+        w.emit(indent, 'r = {}(s, end)'.format(w.call(e)))
+        w.emit(indent, 'if r is None:')
+        w.emit(indent + 1, 'return None')
+        w.emit(indent, 'end, u = r')
+        w.emit(indent, 't += u')
+
+def _alternation(w, pattern, indent, memo):
+    '''Writes the code that parses the alternation pattern at loc, trying only the alternatives that can start there if their
+    first sets are known.'''
+    n = w.position(pattern)
+    table = Dispatcher._table(pattern, memo) if len(pattern.exprs) >= 4 else None
+    if table is None:
+        w.emit(indent, 'r = {}(s, loc)'.format(w.call(pattern.exprs[0])))
+        for e in pattern.exprs[1:]:
+            w.emit(indent, 'if r is None:')
+            w.emit(indent + 1, 'r = {}(s, loc)'.format(w.call(e)))
+        w.emit(indent, 'if r is None:')
+        w.emit(indent + 1, 'return None')
+    else:
+        w.emit(indent, 'for f in _alternatives(s, loc, _t{}):'.format(n))
+        w.emit(indent + 1, 'r = f(s, loc)')
+        w.emit(indent + 1, 'if r is not None:')
+        w.emit(indent + 2, 'break')
+        w.emit(indent, 'else:')
+        w.emit(indent + 1, 'return None')
+        w.tables.append((n, table))
+    w.emit(indent, 'end, t = r')
+
+def _tableSource(w, table):
+    '''Returns the source of the dispatch table for an alternation, as used by _alternatives() in the generated module: a tuple
+    (byChar, nonAscii, byWord, always), where byWord maps a character to a tuple of (length, caseless, words) for the keywords
+    that start with it, and the alternatives are tuples of (position, function).'''
+    byChar, nonAscii, byWord, keywordLengths, always = table
+    def alternatives(alts):
+        return '({})'.format(''.join('({}, {}), '.format(k, w.call(e)) for k, e in alts))
+    chars = '{{{}}}'.format(', '.join('{!r}: {}'.format(c, alternatives(alts)) for c, alts in sorted(byChar.items())))
+    first = {}
+    for length, caseless in keywordLengths:
+        words = byWord[(length, caseless)]
+        for c in sorted(set(c for word in words for c in ((word[0], word[0].lower()) if caseless else (word[0],)))):
+            first.setdefault(c, []).append('({}, {}, {{{}}})'.format(length, caseless,
+                ', '.join('{!r}: {}'.format(word, alternatives(alts)) for word, alts in sorted(words.items()))))
+    words = '{{{}}}'.format(', '.join('{!r}: ({}, )'.format(c, ', '.join(groups)) for c, groups in sorted(first.items())))
+    return '({}, {}, {}, {})'.format(chars, alternatives(nonAscii), words, alternatives(always))
+
+def _function(w, pattern, memo):
+    '''Writes the functions _p<position> and _e<position> that parse pattern, without and with skipping what precedes it. They return
+    a tuple of the end position and the ParseResults, or None if the pattern does not match.'''
+    n = w.position(pattern)
+    kind = _kind(pattern)
+    if kind is None:
+        node = w.bind('_n{}'.format(n), '_N[{}]'.format(n))
+        for name, preParse in (('_p', False), ('_e', True)):
+            w.emit(0, 'def {}{}(s, loc):'.format(name, n))
+            w.emit(1, 'try:')
+            w.emit(2, 'return {}._parse(s, loc, True, {})'.format(node, preParse))
+            w.emit(1, 'except (ParseException, IndexError):')
+            w.emit(2, 'return None')
+            w.emit(0, '')
+        return
+    if kind in ('literal', 'keyword', 'regex', 'empty'):
+        for name, preParse in (('_p', False), ('_e', True)):
+            w.emit(0, 'def {}{}(s, loc):'.format(name, n))
+            if preParse:
+                _skip(w, pattern, 1)
+            _terminal(w, pattern, kind, 1)
+            w.emit(0, '')
+        return
+    w.emit(0, 'def _p{}(s, loc):'.format(n))
+    if kind == 'and':
+        _sequence(w, pattern, 1)
+    elif kind == 'first':
+        _alternation(w, pattern, 1, memo)
+    elif kind == 'opt':
+        w.emit(1, 'r = {}(s, loc)'.format(w.call(pattern.expr, False)))
+        w.emit(1, 'if r is None:')
+        w.emit(2, 'end = loc')
+        if pattern.defaultValue is _optionalNotMatched:
+            w.emit(2, 't = []')
+        else:
+            default = w.bind('_d{}'.format(n), '_N[{}].defaultValue'.format(n))
+            if pattern.expr.resultsName:
+                w.emit(2, 't = _PR([{}])'.format(default))
+                w.emit(2, 't[{!r}] = {}'.format(pattern.expr.resultsName, default))
+            else:
+                w.emit(2, 't = [{}]'.format(default))
+        w.emit(1, 'else:')
+        w.emit(2, 'end, t = r')
+    elif kind == 'more':
+        w.emit(1, 'r = {}(s, loc)'.format(w.call(pattern.expr)))
+        w.emit(1, 'if r is None:')
+        if isinstance(pattern, ZeroOrMore):
+            w.emit(2, 'end = loc')
+            w.emit(2, 't = _PR([], {!r})'.format(pattern.resultsName))
+        else:
+            w.emit(2, 'return None')
+        w.emit(1, 'else:')
+        w.emit(2, 'end, t = r')
+        w.emit(2, 'while True:')
+        w.emit(3, 'r = {}(s, end)'.format(w.call(pattern.expr)))
+        w.emit(3, 'if r is None:')
+        w.emit(4, 'break')
+        w.emit(3, 'end, u = r')
+        w.emit(3, 't += u')
+    elif kind == 'not':
+        w.emit(1, 'if {}(s, loc) is not None:'.format(w.call(pattern.expr)))
+        w.emit(2, 'return None')
+        w.emit(1, 'end = loc')
+        w.emit(1, 't = []')
+    else:
+        w.emit(1, 'r = {}(s, loc)'.format(w.call(pattern.expr, False)))
+        w.emit(1, 'if r is None:')
+        w.emit(2, 'return None')
+        if type(pattern).postParse is ParserElement.postParse:
+            w.emit(1, 'end, t = r')
+        elif type(pattern) is Suppress:
+            w.emit(1, 'end = r[0]')
+            w.emit(1, 't = []')
+        elif type(pattern) is Group and not getattr(pattern, '_asPythonList', False):
+            w.emit(1, 'end = r[0]')
+            w.emit(1, 't = [r[1]]')
+        else:
+            node = w.bind('_n{}'.format(n), '_N[{}]'.format(n))
+            w.emit(1, 'end, u = r')
+            w.emit(1, 't = {}.postParse(s, end, u)'.format(node))
+    _results(w, pattern, 1)
+    w.emit(0, '')
+    if pattern.callPreparse and pattern.skipWhitespace and pattern.whiteChars:
+        w.emit(0, 'def _e{}(s, loc):'.format(n))
+        w.emit(1, 'return _p{}(s, {}(s, loc).end())'.format(n, w.white(pattern.whiteChars)))
+    else:
+        w.emit(0, '_e{0} = _p{0}'.format(n))
+    w.emit(0, '')
+
+_HEADER = """\'\'\'
+Recursive-descent parser for the grammar of a parser defined in {module}, generated by parsertools.generator. Do not edit this
+module; generate it again when the grammar changes.
+\'\'\'
+import re
+from inspect import signature
+from operator import attrgetter
+import pyparsing
+from pyparsing import ParserElement, ParseResults as _PR, ParseException
+from parsertools import ParsertoolsException
+from parsertools.generator import grammarPatterns, grammarFingerprint
+
+FINGERPRINT = {fingerprint!r}
+PYPARSING_VERSION = {version!r}
+
+if 'aslist' in signature(_PR.__init__).parameters:
+    def _named(t, name, aslist, modal):
+        return _PR(t, name, aslist=aslist, modal=modal)
+else:
+    def _named(t, name, aslist, modal):
+        return _PR(t, name, asList=aslist, modal=modal)
+
+"""
+
+_BIND = """
+_merged = {{}}
+
+def _alternatives(s, loc, table):
+    \'\'\'Returns the alternatives of an alternation, as functions in their original order, that can start at loc.\'\'\'
+    byChar, nonAscii, byWord, always = table
+    start = {white}(s, loc).end()
+    c = s[start:start + 1]
+    alternatives = nonAscii if c > '\\x7f' else byChar.get(c, always)
+    for length, caseless, words in byWord.get(c, ()):
+        word = s[start:start + length]
+        found = words.get(word.upper() if caseless else word)
+        if found:
+            key = (alternatives, found)
+            if key not in _merged:
+                _merged[key] = tuple(sorted(set(alternatives).union(found), key=lambda a: a[0]))
+            alternatives = _merged[key]
+    return [f for _, f in alternatives]
+
+_bound = None
+_entries = {{}}
+_N = []
+_ignoreExprs = attrgetter('ignoreExprs')
+
+def _bind(parser):
+    \'\'\'Takes the parse actions and the patterns that the functions of this module use from the grammar of parser, after checking
+    that it is the grammar this module was generated from.\'\'\'
+    global _bound, _entries, _N
+    roots, nodes = grammarPatterns(parser)
+    if grammarFingerprint(nodes) != FINGERPRINT:
+        raise ParsertoolsException('The grammar of the parser is not the one this module was generated from (with pyparsing {{}}, '
+                                   'now {{}})'.format(PYPARSING_VERSION, pyparsing.__version__))
+    _N = nodes
+    globals().update({{
+"""
+
+_FOOTER = """    }})
+    _entries = dict((getattr(parser, name), (globals()['_e{{}}'.format(n)], _N[n])) for name, n in roots)
+    _bound = parser
+
+def parse(class_, text):
+    \'\'\'Parses text as an element of class_, and returns the result, as class_._pattern.parseString(text, parseAll=True)[0] does.
+    Raises a ParseException if text is not an element of class_, and a ParsertoolsException if class_ is not an element class of
+    the grammar this module was generated from, if expressions to be ignored have been added to the grammar, or if left recursion
+    is enabled.\'\'\'
+    if class_._parser is not _bound:
+        _bind(class_._parser)
+    entry = _entries.get(class_)
+    if entry is None:
+        raise ParsertoolsException('{{}} is not an element class of the grammar of this module'.format(class_.__name__))
+    if getattr(ParserElement, '_left_recursion_enabled', False) or any(map(_ignoreExprs, _N)):
+        raise ParsertoolsException('This module does not support ignored expressions and left recursion')
+    f, pattern = entry
+    if not pattern.keepTabs:
+        text = text.expandtabs()
+    r = f(text, 0)
+    if r is None:
+        raise ParseException(text, {white}(text, 0).end(), 'Expected {{}}'.format(class_.__name__))
+    end = {white}(text, pattern.preParse(text, r[0])).end()
+    if end != len(text):
+        raise ParseException(text, end, 'Expected end of text')
+    return r[1][0]
+"""
+
+def generateParser(parser, out=None):
+    '''Returns the source of a recursive-descent parser module for the grammar of parser. If out is given, it must be a text
+    stream, to which the source is written, and None is returned.
+    The generated module is used by setting it as the compiled attribute of parser, or of another parser with the same grammar,
+    see the Parser class. It does not import the module that defines parser.'''
+    if out is None:
+        out = io.StringIO()
+        generateParser(parser, out)
+        return out.getvalue()
+    roots, nodes = grammarPatterns(parser)
+    if not roots:
+        raise ParsertoolsException('Parser has no elements to generate a parser for')
+    w = _Writer(nodes)
+    memo = {}
+    default = w.white(ParserElement.DEFAULT_WHITE_CHARS)
+    for pattern in nodes:
+        _function(w, pattern, memo)
+    out.write(_HEADER.format(module=getattr(parser, roots[0][0]).__module__, fingerprint=grammarFingerprint(nodes),
+                             version=pyparsing.__version__))
+    for chars, white in sorted(w.whites.items(), key=lambda item: item[1]):
+        out.write('{} = re.compile({!r}).match\n'.format(white, '[{}]*'.format(re.escape(chars))))
+    out.write('\n')
+    for line in w.lines:
+        out.write(line.rstrip() + '\n')
+    for n, table in w.tables:
+        out.write('_t{} = {}\n'.format(n, _tableSource(w, table)))
+    out.write(_BIND.format(white=default))
+    for binding in w.bindings:
+        out.write('        {!r}: {},\n'.format(*binding))
+    out.write(_FOOTER.format(white=default))
+
+def loadParser(parser):
+    '''Returns the module generated by generateParser(parser), imported without writing its source to a file, for instance to
+    compare its parses with those of the grammar in tests.'''
+    source = generateParser(parser)
+    result = types.ModuleType('generatedparser')
+    exec(compile(source, '<generated parser>', 'exec'), vars(result))
+    return result
@@ -4,7 +4,7 @@ Created on 29 apr. 2016
 @author: jeroenbruijning
 '''
 from pyparsing import *
-from parsertools.base import ParseStruct, parseStructFunc, separatedList
+from parsertools.base import ParseStruct, parseStructFunc, separatedList, VALIDATION_LEVELS, Dispatcher
 from parsertools import ParsertoolsException
 from pip._vendor.pyparsing import stringEnd
 
@@ -24,6 +24,8 @@ class N3Element(ParseStruct):
     '''Optional subclass of ParseStruct for the language. Typically, this class contains attributes and methods for the language that
     go beyond context free parsing, such as pre- and post processing, checking for conditions not covered by the grammar, etc.'''
     
+    __slots__ = ()
+    
     def __init__(self, expr):
         '''This constructor has an optional argument "base". This is the externally determined base iri, as per SPARQL definition par. 4.1.1.2.
         It is only applied when the constructor is called with a string as expression to be parsed. (For internal bootstrapping purposes,
@@ -130,16 +132,47 @@ class Parser:
     Optionally, it takes a class argument if the language demands functionality in its
     ParseStruct elements that goes beyond what is provided in base.py. The argument must be
     a subclass of ParseStruct. The default is to instantiate the parser as a ParseStruct 
-    parser.'''
+    parser.
+    The validation argument sets the validation level for the elements of the parser, see setValidation().
+    If spans is True, parsed elements record their position in the parsed string, see ParseStruct.getSpan().
+    If collapse is True, chains of elements that have a single element as their only item are stored as one compressed element,
+    and the elided elements are created when needed.
+    If shareLeaves is True, elements for fixed-text terminals (literals and keywords) are shared, immutable instances without a
+    parent pointer, until they are handed out by getItems() or a search (see base._sharedLeaf()).
+    If internTable is given (see base.InternTable), the strings in parsed elements are taken from it, so that equal strings are
+    shared within and between parse trees.
+    If weakParents is True, parent pointers are weak references, so that parse trees do not form reference cycles. The top element
+    of a tree must then be kept alive for as long as the tree is used.
+    If pauseGC is True, the cyclic garbage collector is suspended while parsing, and gcStats is set after each parse, see base._parse().
+    If compiled is given (a module generated with generator.generateParser()), it parses instead of the grammar.
+    The dispatcher attribute holds the Dispatcher that is installed in the grammar when it is complete, at the end of this module
+    (see base.Dispatcher): alternations only try the alternatives that can start at the position.'''
     
-    def __init__(self, class_=ParseStruct):
+    def __init__(self, class_=ParseStruct, validation='full', spans=False, collapse=False, shareLeaves=False, internTable=None,
+                 weakParents=False, pauseGC=False, compiled=None):
         self.class_ = class_
+        self.spans = spans
+        self.collapse = collapse
+        self.shareLeaves = shareLeaves
+        self.internTable = internTable
+        self.weakParents = weakParents
+        self.pauseGC = pauseGC
+        self.gcStats = None
+        self.dispatcher = None
+        self.compiled = compiled
+        self.setValidation(validation)
+    def setValidation(self, validation):
+        '''Sets the level of the internal consistency checks done by parse actions and updateWith(), one of VALIDATION_LEVELS
+        ('off', 'cheap' or 'full'). Level 'full' is meant for development and testing, 'off' for production use.'''
+        if not validation in VALIDATION_LEVELS:
+            raise ParsertoolsException('Validation level must be one of {}, got {}'.format(VALIDATION_LEVELS, validation))
+        self.validation = validation
     def addElement(self, pattern, newclass=None):
         if newclass:
             assert issubclass(newclass, self.__class)
         else:
             newclass = self.class_ 
-        setattr(self, pattern.name, type(pattern.name, (newclass,), {'_pattern': pattern}))
+        setattr(self, pattern.name, type(pattern.name, (newclass,), {'_pattern': pattern, '_parser': self, '__slots__': ()}))
         pattern.setParseAction(parseStructFunc(getattr(self, pattern.name)))
 
 #
@@ -604,5 +637,5 @@ N3Parser.addElement(Pathlist)
 Document = Group(StatementsOptional).setName('Document') 
 N3Parser.addElement(Document)
 
-
-
+# Alternations dispatch on the first character or keyword of their alternatives from here on, see base.Dispatcher
+N3Parser.dispatcher = Dispatcher(N3Parser)
@@ -4,7 +4,7 @@ Created on 28 mrt. 2016
 @author: jeroenbruijning
 '''
 from pyparsing import *
-from parsertools.base import ParseStruct, parseStructFunc, separatedList
+from parsertools.base import ParseStruct, parseStructFunc, separatedList, VALIDATION_LEVELS, Dispatcher
 from parsertools import ParsertoolsException, NoPrefixError
 import rfc3987
 import re
@@ -25,19 +25,26 @@ class SPARQLElement(ParseStruct):
     '''Optional subclass of ParseStruct for the language. Typically, this class contains attributes and methods for the language that
     go beyond context free parsing, such as pre- and post processing, checking for conditions not covered by the grammar, etc.'''
     
-    def __init__(self, expr, base=None, postParseCheck=True):
+    __slots__ = ('_prefixes', '_baseiri')
+    
+    def __init__(self, expr, base=None, postParseCheck=True, index=True):
         '''This constructor has an optional argument "base". This is the externally determined base iri, as per SPARQL definition par. 4.1.1.2.
         It is only applied when the constructor is called with a string as expression to be parsed. (For internal bootstrapping purposes,
-        the constructor can also be called with expr equal to "None". See also the documentation for the ParseStruct constructor.)'''
+        the constructor can also be called with expr equal to "None". See also the documentation for the ParseStruct constructor.)
+        If index is True, an index of the parsed tree is built (see ParseStruct.buildIndex()), which speeds up the searches done in
+        post processing. No index is built for compressed trees, as building it would create all their elements.
+        The post parse checks do not depend on the validation level of the parser; they are only skipped if postParseCheck is False.'''
         ParseStruct.__init__(self, expr)
-        self.__dict__['_prefixes'] = {}
-        self.__dict__['_baseiri'] = None
+        self._set('_prefixes', {})
+        self._set('_baseiri', None)
         if not expr is None:
+            if index and not (self._parser and self._parser.collapse):
+                self.buildIndex()
             self._applyPrefixesAndBase(baseiri=base)
             if postParseCheck:
                 self._checkParsedQuery()
                     
-    def _applyPrefixesAndBase(self, prefixes={}, baseiri=None):
+    def _applyPrefixesAndBase(self, prefixes=None, baseiri=None):
         '''Recursively attaches information to the element about the prefixes and base-iri valid at this point
         in the expression, as determined by PREFIX and BASE declarations in the query.
         The parameter baseiri is as determined by the environment or an enveloping parsed entity. It must be an absolute
@@ -47,29 +54,63 @@ class SPARQLElement(ParseStruct):
         using the baseiri parameter (which may not be None in this case) to give the next base IRI in force.
         Successful termination of this method does not guarantee that IRI expansion is possible, or that expanded IRIs conform to RFC 3987.
         This is purely a syntactic (substitution) operation. Use other available tests afterwards to check whether iris can be correctly
-        expanded using base and prefixes in force at their location. The function _checkParsedQuery can be used for this.'''
+        expanded using base and prefixes in force at their location. The function _checkParsedQuery can be used for this.
+        If the items of the element have not been materialized yet, the information is passed on to them when they are, see _materialize().
+        If prefixes is None, the element starts with an empty prefixes dict of its own.'''
         
-        self.__dict__['_prefixes'] = prefixes
-        self.__dict__['_baseiri'] = baseiri
+        self._set('_prefixes', {} if prefixes is None else prefixes)
+        self._set('_baseiri', baseiri)
         if baseiri:
             assert rfc3987.parse(baseiri, rule='absolute_IRI')
-        prefixes = prefixes.copy()
-        for elt in self.getChildren():
+        if not self._isLazy():
+            self._passPrefixesAndBase()
+            
+    def _passPrefixesAndBase(self, new=None):
+        '''Applies the prefixes and base-iri of the element to its children, see _applyPrefixesAndBase(). For a compressed element,
+        they are applied to its stored items, unless a Prologue is elided. Shared leaves (see base._sharedLeaf()) are skipped, as they
+        have no context of their own. If new is given, it must be a list of children, and only these are applied to (see _unshare()).
+        The prefixes dict is shared with the children, and only copied when a prefix declaration adds to it.'''
+        if self._isCompressed() and any(c is SPARQLParser.Prologue for c, _ in self._items.links):
+            self.getItems()
+        prefixes = self._prefixes
+        baseiri = self._baseiri
+        for elt in [i for i in self._storedItems() if isinstance(i, ParseStruct) and not i._isShared()]:
             if isinstance(elt, SPARQLParser.Prologue):
                 for decl in elt.getChildren():
                     if isinstance(decl, SPARQLParser.PrefixDecl):
                         assert str(decl.prefix) not in prefixes, 'Prefixes: {}, prefix: {}'.format(prefixes, decl.prefix)
-                        prefixes[str(decl.prefix)] = str(decl.namespace)[1:-1]
+                        if prefixes is self._prefixes:
+                            prefixes = prefixes.copy()
+                        prefixes[self._intern(str(decl.prefix))] = self._intern(str(decl.namespace)[1:-1])
                     else:
                         assert isinstance(decl, SPARQLParser.BaseDecl)
                         iripart = str(decl.baseiri)[1:-1]
                         try:
                             rfc3987.parse(iripart, rule='absolute_IRI')
-                            baseiri = iripart
+                            baseiri = self._intern(iripart)
                         except ValueError:
-                            baseiri = rfc3987.resolve(baseiri, str(decl.baseiri)[1:-1])
+                            baseiri = self._intern(rfc3987.resolve(baseiri, str(decl.baseiri)[1:-1]))
                             assert rfc3987.parse(baseiri, rule='absolute_IRI')                            
-            elt._applyPrefixesAndBase(prefixes, baseiri)
+            if new is None or any(elt is e for e in new):
+                elt._applyPrefixesAndBase(prefixes, baseiri)
+    
+    def _intern(self, s):
+        '''Returns s, taken from the intern table of the parser if it has one (see base.InternTable).'''
+        table = self._parser.internTable if self._parser else None
+        return table.intern(s) if table is not None else s
+            
+    def _unshare(self):
+        '''Replaces the shared leaves among the items of the element by elements of their own (see ParseStruct._unshare()),
+        and applies the prefixes and base-iri in force to them.'''
+        new = ParseStruct._unshare(self)
+        if new:
+            self._passPrefixesAndBase(new)
+        return new
+    
+    def _materialize(self):
+        '''Materializes the items of the element (see ParseStruct._materialize()), and applies the prefixes and base-iri of the element to them.'''
+        ParseStruct._materialize(self)
+        self._passPrefixesAndBase()
             
     def getPrefixes(self):
         return self._prefixes
@@ -79,18 +120,26 @@ class SPARQLElement(ParseStruct):
         
     def expandIris(self):
         '''Converts all contained iri elements to normal form, taking into account the prefixes and base in force at the location of the iri.
-        The expansions are performed in place.'''
-        for elt in self.searchElements(element_type=SPARQLParser.iri):
-            children = elt.getChildren()
-            assert len(children) == 1, children
-            child = children[0]
-            newiriref = '<' + getExpansion(child) + '>'
-            elt.updateWith(newiriref)
+        The expansions are performed in place, as a single batch edit.'''
+        with self.batchEdit() as batch:
+            for elt in self.searchElements(element_type=SPARQLParser.iri):
+                children = elt.getChildren()
+                assert len(children) == 1, children
+                child = children[0]
+                newiriref = '<' + getExpansion(child) + '>'
+                if newiriref != str(elt):
+                    batch.replace(elt, newiriref)
              
     def processEscapeSeqs(self):
-        for stringtype in [SPARQLParser.STRING_LITERAL2, SPARQLParser.STRING_LITERAL1, SPARQLParser.STRING_LITERAL_LONG1, SPARQLParser.STRING_LITERAL_LONG2]:
-            for elt in self.searchElements(element_type=stringtype):
-                elt.updateWith(stringEscape(str(elt)))
+        '''Replaces the escape sequences in all contained string literals, as a single batch edit. Literals without escape sequences
+        are left as they are.'''
+        with self.batchEdit() as batch:
+            for stringtype in [SPARQLParser.STRING_LITERAL2, SPARQLParser.STRING_LITERAL1, SPARQLParser.STRING_LITERAL_LONG1, SPARQLParser.STRING_LITERAL_LONG2]:
+                for elt in self.searchElements(element_type=stringtype):
+                    old = str(elt)
+                    new = stringEscape(old)
+                    if new != old:
+                        batch.replace(elt, new)
 
     def _checkExpansion(self):
         iris = self.searchElements(element_type=SPARQLParser.PrefixedName) + self.searchElements(element_type=SPARQLParser.IRIREF)
@@ -118,10 +167,41 @@ class Parser:
     Optionally, it takes a class argument if the language demands functionality in its
     ParseStruct elements that goes beyond what is provided in base.py. The argument must be
     a subclass of ParseStruct. The default is to instantiate the parser as a ParseStruct 
-    parser.'''
+    parser.
+    The validation argument sets the validation level for the elements of the parser, see setValidation().
+    If spans is True, parsed elements record their position in the parsed string, see ParseStruct.getSpan().
+    If collapse is True, chains of elements that have a single element as their only item are stored as one compressed element,
+    and the elided elements are created when needed.
+    If shareLeaves is True, elements for fixed-text terminals (literals and keywords) are shared, immutable instances without a
+    parent pointer, until they are handed out by getItems() or a search (see base._sharedLeaf()).
+    If internTable is given (see base.InternTable), the strings in parsed elements are taken from it, so that equal strings are
+    shared within and between parse trees.
+    If weakParents is True, parent pointers are weak references, so that parse trees do not form reference cycles. The top element
+    of a tree must then be kept alive for as long as the tree is used.
+    If pauseGC is True, the cyclic garbage collector is suspended while parsing, and gcStats is set after each parse, see base._parse().
+    If compiled is given (a module generated with generator.generateParser()), it parses instead of the grammar.
+    The dispatcher attribute holds the Dispatcher that is installed in the grammar when it is complete, at the end of this module
+    (see base.Dispatcher): alternations only try the alternatives that can start at the position.'''
     
-    def __init__(self, class_=ParseStruct):
+    def __init__(self, class_=ParseStruct, validation='full', spans=False, collapse=False, shareLeaves=False, internTable=None,
+                 weakParents=False, pauseGC=False, compiled=None):
         self.class_ = class_
+        self.spans = spans
+        self.collapse = collapse
+        self.shareLeaves = shareLeaves
+        self.internTable = internTable
+        self.weakParents = weakParents
+        self.pauseGC = pauseGC
+        self.gcStats = None
+        self.dispatcher = None
+        self.compiled = compiled
+        self.setValidation(validation)
+    def setValidation(self, validation):
+        '''Sets the level of the internal consistency checks done by parse actions and updateWith(), one of VALIDATION_LEVELS
+        ('off', 'cheap' or 'full'). Level 'full' is meant for development and testing, 'off' for production use.'''
+        if not validation in VALIDATION_LEVELS:
+            raise ParsertoolsException('Validation level must be one of {}, got {}'.format(VALIDATION_LEVELS, validation))
+        self.validation = validation
 #     def addElement(self, pattern):
 #         setattr(self, pattern.name, type(pattern.name, (self.class_,), {'_pattern': pattern}))
 #         pattern.setParseAction(parseStructFunc(getattr(self, pattern.name)))
@@ -130,7 +210,7 @@ class Parser:
             assert issubclass(newclass, self.class_)
         else:
             newclass = self.class_ 
-        setattr(self, pattern.name, type(pattern.name, (newclass,), {'_pattern': pattern}))
+        setattr(self, pattern.name, type(pattern.name, (newclass,), {'_pattern': pattern, '_parser': self, '__slots__': ()}))
         pattern.setParseAction(parseStructFunc(getattr(self, pattern.name)))
 #
 # Create the SPARQLParser object, optionally with a custom ParseStruct subclass
@@ -143,7 +223,9 @@ SPARQLParser = Parser(SPARQLElement)
 #
 
 def parseQuery(querystring, base=None):
-    '''Entry point to parse any SPARQL query'''
+    '''Entry point to parse any SPARQL query. The query is parsed after prepareQuery(), which strips comments and replaces codepoint
+    escape sequences, so the spans of the elements (see ParseStruct.getSpan()) are positions in the prepared query, which
+    getParsedString() returns, and not in querystring.'''
     
     s = prepareQuery(querystring)
     
@@ -180,7 +262,9 @@ def stripComments(text):
         text = '\n'.join(text)
     Comment = Literal('#') + SkipTo(lineEnd)
     NormalText = Regex('[^#<\'"]+')    
-    Line = ZeroOrMore(String | (IRIREF | Literal('<')) | NormalText) + Optional(Comment) + lineEnd
+    # The string and IRI patterns are built anew, since Line.ignore() would otherwise add Comment to the patterns of the grammar
+    Strings = MatchFirst([Regex(e) for e in (STRING_LITERAL_LONG1_e, STRING_LITERAL_LONG2_e, STRING_LITERAL1_e, STRING_LITERAL2_e)])
+    Line = ZeroOrMore(Strings | (Regex(IRIREF_e) | Literal('<')) | NormalText) + Optional(Comment) + lineEnd
     Line.ignore(Comment)
     Line.setParseAction(lambda tokens: ' '.join([t if isinstance(t, str) else t.__str__() for t in tokens]))
     lines = text.split('\n')
@@ -204,7 +288,7 @@ def unescapeUcode(s):
 # def isInScope(variable, element):
 #     assert isinstance(element, (SPARQLParser.GroupGraphPattern, SPARQLParser.Path, SPARQLParser.GroupOrUnionGraphPattern, SPARQLParser.GraphGraphPattern, SPARQLParser.InlineData, SPARQLParser., SPARQLParser.SubSelect, ))
 #     if isinstance(element, SPARQLParser.GroupGraphPattern):
-#         return element in variable.getAncestors()
+#         return variable.isDescendantOf(element)
     
 def getExpansion(iri):
     '''Converts iri (or PrefixedName, or IRIREF) to normal form by replacing prefixes, if any, with their value and resolving the result, if relative, to absolute form.'''
@@ -1563,4 +1647,5 @@ SPARQLParser.addElement(Query)
 QueryUnit = Group(Query).setName('QueryUnit')
 SPARQLParser.addElement(QueryUnit)
 
-
+# Alternations dispatch on the first character or keyword of their alternatives from here on, see base.Dispatcher
+SPARQLParser.dispatcher = Dispatcher(SPARQLParser)
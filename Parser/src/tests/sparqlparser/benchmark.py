@@ -0,0 +1,77 @@
+'''
+Parse benchmark for SPARQLParser. Parses a sample of the pass cases of grammar_unittest.py with the default settings and with each
+of the parser options set, and prints the best time of a number of runs: for parsing only, as the constructors of the element classes
+do, and for constructing the elements, without their post parse checks.
+
+Usage, from this directory: python benchmark.py [step [runs]]
+The sample holds every step-th case (default 20); each setting is timed runs times (default 3).
+'''
+import sys
+import time
+from parsertools.base import _parse
+from parsertools.generator import loadParser
+from parsertools.parsers.sparqlparser import SPARQLParser
+import grammar_unittest
+
+def cases(step):
+    '''Returns every step-th pass case of grammar_unittest.py, as a list of (element class, string), leaving out the cases that
+    cannot be constructed as elements on their own (such as a Prologue declaring a prefix twice).'''
+    test = grammar_unittest.Test('setUp')
+    test.setUp()
+    result = []
+    for rule, rulecases in test.testCases.items():
+        if hasattr(SPARQLParser, rule):
+            result.extend((getattr(SPARQLParser, rule), s) for s in rulecases['pass'])
+    return [case for case in result[::step] if constructible(*case)]
+
+def constructible(class_, s):
+    '''Returns True if construct(class_, s) succeeds. Relative BASE declarations, for example, fail without a base iri.'''
+    try:
+        construct(class_, s)
+        return True
+    except Exception:
+        return False
+
+def compiledModule():
+    '''Returns the generated parser module for SPARQLParser, see generator.loadParser().'''
+    return loadParser(SPARQLParser)
+
+def settings():
+    '''Returns the settings to time, as a list of (name, dict of parser attributes).'''
+    result = [('default', {})]
+    result.extend((option, {option: True}) for option in ('collapse', 'shareLeaves', 'weakParents', 'pauseGC'))
+    result.append(("validation='off'", {'validation': 'off'}))
+    result.append(('compiled', {'compiled': compiledModule()}))
+    return result
+
+def parse(class_, s):
+    '''Parses s as an element of class_, as the constructors do.'''
+    return _parse(class_, s)
+
+def construct(class_, s):
+    '''Constructs an element of class_ from s, without post parse checks.'''
+    return class_(s, postParseCheck=False)
+
+def run(sample, function=parse):
+    '''Calls function for each of the cases in sample, and returns the time taken in seconds.'''
+    start = time.perf_counter()
+    for class_, s in sample:
+        function(class_, s)
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    step = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    sample = cases(step)
+    print('{} cases'.format(len(sample)))
+    print('{:20} {:>8} {:>10}'.format('setting', 'parse', 'construct'))
+    for name, attributes in settings():
+        saved = dict((k, getattr(SPARQLParser, k)) for k in attributes)
+        for k, v in attributes.items():
+            setattr(SPARQLParser, k, v)
+        try:
+            times = [min(run(sample, function) for _ in range(runs)) for function in (parse, construct)]
+            print('{:20} {:7.3f}s {:9.3f}s'.format(name, *times))
+        finally:
+            for k, v in saved.items():
+                setattr(SPARQLParser, k, v)
@@ -4,9 +4,24 @@ Created on 20 apr. 2016
 @author: jeroenbruijning
 '''
 import unittest
-
+import io
+import gc
+import weakref
+import os
+import re
+import tempfile
+import importlib.util
+import unittest.mock
+import concurrent.futures
+import pyparsing
+from pyparsing import Literal, Group, MatchFirst, ParseException
+
+from parsertools import ParsertoolsException
+from parsertools.base import _stringHash, _firstChars, _lazyCopies, _DispatchingMatchFirst, InternTable, freezeTrees, unfreezeTrees
 from parsertools.parsers.sparqlparser import SPARQLParser, SPARQLParseException
-from parsertools.parsers.sparqlparser import stripComments, parseQuery, unescapeUcode
+from parsertools.parsers.sparqlparser import stripComments, parseQuery, unescapeUcode, prepareQuery, Parser
+from parsertools.analysis import analyzeGrammar, reportGrammar
+from parsertools.generator import generateParser, loadParser
 
 
 class Test(unittest.TestCase):
@@ -32,7 +47,52 @@ class Test(unittest.TestCase):
         r_copy = r.copy()
         assert r_copy == r
         assert not r_copy is r
-        
+
+    def testCopyVariants(self):
+        q = '''
+PREFIX foaf:   <http://xmlns.com/foaf/0.1/>
+
+SELECT ?p WHERE { ?p a foaf:Person }
+'''
+        r = parseQuery(q)
+        for kwargs in [dict(), dict(lazy=True)]:
+            r_copy = r.copy(**kwargs)
+            assert r_copy == r and r_copy.getParent() is None
+            name = r_copy.searchFirst(element_type=SPARQLParser.PrefixedName)
+            assert name.getPrefixes() == {'foaf:': 'http://xmlns.com/foaf/0.1/'}
+            assert name.getLabel() == r.searchFirst(element_type=SPARQLParser.PrefixedName).getLabel()
+            assert name.getRoot() is r_copy and r_copy.hasParentPointers()
+            r_copy.expandIris()
+            assert str(r_copy.searchFirst(element_type=SPARQLParser.TriplesBlock)) == '?p a <http://xmlns.com/foaf/0.1/Person>'
+            assert str(r.searchFirst(element_type=SPARQLParser.TriplesBlock)) == '?p a foaf:Person'
+            assert r.hasParentPointers()
+        original = str(r)
+        r_copy = r.copy(lazy=True)
+        where = r.searchFirst(element_type=SPARQLParser.WhereClause)
+        depth = where.searchFirst(element_type=SPARQLParser.Var).getDepth() - where.getDepth()
+        where_copy = where.copy(lazy=True)
+        assert where_copy.getDepth() == 0 and not where_copy.isDescendantOf(r)
+        assert where_copy.searchFirst(element_type=SPARQLParser.Var).getDepth() == depth
+        r.searchFirst(element_type=SPARQLParser.Var).updateWith('?q')
+        with r.batchEdit() as batch:
+            batch.replace(r.searchFirst(element_type=SPARQLParser.PrefixedName), 'foaf:Agent')
+        assert str(r_copy) == original and r_copy == parseQuery(q) and hash(r_copy) == hash(parseQuery(q))
+        assert [str(v) for v in r_copy.searchElements(element_type=SPARQLParser.Var)] == ['?p', '?p']
+        assert str(where_copy) == 'WHERE { ?p a foaf:Person }' and where_copy.getChildren()[0].getParent() is where_copy
+        r = parseQuery(q)
+        copies = [r.copy(lazy=True) for _ in range(3)]
+        del copies[0]
+        assert len(_lazyCopies[id(r)][1]) == 2
+        del copies
+        gc.collect()
+        assert not id(r) in _lazyCopies
+        r = parseQuery(q)
+        r_copy = r.copy(deep=False)
+        assert r_copy == r and r_copy.getChildren()[0] is r.getChildren()[0]
+        assert r.getChildren()[0].getParent() is r
+        r_copy.updateWith('SELECT * {}')
+        assert str(r) == 'PREFIX foaf: <http://xmlns.com/foaf/0.1/> SELECT ?p WHERE { ?p a foaf:Person }'
+
     def testStr(self):
         s = "'work' ^^<work:>"
         r = SPARQLParser.RDFLiteral(s)
@@ -75,7 +135,223 @@ SELECT ?p WHERE
         assert str(subjpath.getParent()) == '<http://xmlns.com/foaf/0.1/Person>'
         assert str(subjpath.getAncestors()) == '[iri("<http://xmlns.com/foaf/0.1/Person>"), GraphTerm("<http://xmlns.com/foaf/0.1/Person>"), VarOrTerm("<http://xmlns.com/foaf/0.1/Person>"), GraphNodePath("<http://xmlns.com/foaf/0.1/Person>"), ObjectPath("<http://xmlns.com/foaf/0.1/Person>"), ObjectListPath("<http://xmlns.com/foaf/0.1/Person>"), PropertyListPathNotEmpty("a <http://xmlns.com/foaf/0.1/Person>"), TriplesSameSubjectPath("?p a <http://xmlns.com/foaf/0.1/Person>"), TriplesBlock("?p a <http://xmlns.com/foaf/0.1/Person>"), GroupGraphPatternSub("?p a <http://xmlns.com/foaf/0.1/Person>"), GroupGraphPattern("{ ?p a <http://xmlns.com/foaf/0.1/Person> }"), WhereClause("WHERE { ?p a <http://xmlns.com/foaf/0.1/Person> }"), SelectQuery("SELECT ?p WHERE { ?p a <http://xmlns.com/foaf/0.1/Person> }"), Query("PREFIX foaf: <http://xmlns.com/foaf/0.1/> SELECT ?p WHERE { ?p a <http://xmlns.com/foaf/0.1/Person> }"), QueryUnit("PREFIX foaf: <http://xmlns.com/foaf/0.1/> SELECT ?p WHERE { ?p a <http://xmlns.com/foaf/0.1/Person> }")]'
         assert r.hasParentPointers()
-        
+
+    def testStrCache(self):
+        s = '<c:check#22?> ( $var, ?var )'
+        r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        assert str(r) == '<c:check#22?> ( $var , ?var )'
+        var = r.searchElements(element_type=SPARQLParser.Var)[0]
+        arglist = r.searchElements(element_type=SPARQLParser.ArgList)[0]
+        var.updateWith('?other')
+        assert str(var) == '?other'
+        assert str(arglist) == '( ?other , ?var )'
+        assert str(r) == '<c:check#22?> ( ?other , ?var )'
+
+    def testHash(self):
+        s = '<c:check#22?> ( $var, ?var )'
+        r1 = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        r2 = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        assert r1 == r2 and hash(r1) == hash(r2)
+        assert len({r1, r2}) == 1
+        vars_ = r1.searchElements(element_type=SPARQLParser.Var)
+        assert len(set(vars_)) == 2
+        vars_[0].updateWith('?var')
+        assert len(set(vars_)) == 1
+        assert r1 != r2 and hash(r1) != hash(r2)
+        assert r1._hash == _stringHash(str(r1)) and r1._len == len(str(r1))
+        vars_[0].updateWith('$var')
+        assert r1 == r2 and hash(r1) == hash(r2)
+
+    def testSlotsAndMemoryReport(self):
+        s = '<c:check#22?> ( $var, ?var )'
+        r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        assert not hasattr(r, '__dict__')
+        assert r.getSize(recursive=True) > r.getSize() > 0
+        report = r.memoryReport().split('\n')
+        assert report[-2].split()[:2] == ['total', '31'], report[-2]
+        assert 'ArgList' in r.memoryReport()
+
+    def testLabelIndex(self):
+        s = "'work' ^^<work:>"
+        r = SPARQLParser.RDFLiteral(s)
+        assert r.hasLabel('lexical_form') and not r.hasLabel('nolabel')
+        assert r.getValuesForLabel('lexical_form') == [r.lexical_form]
+        assert r.getValuesForLabel('nolabel') == []
+        r.updateWith("'work2'")
+        assert r.hasLabel('lexical_form') and not r.hasLabel('datatype_uri')
+        assert str(r.lexical_form) == "'work2'"
+        r.updateWith("'work' ^^<work:>")
+        assert str(r.datatype_uri) == '<work:>'
+        assert r.lexical_form._labels is None
+
+    def testElementIndex(self):
+        q = '''
+PREFIX foaf:   <http://xmlns.com/foaf/0.1/>
+
+SELECT ?p WHERE
+    {
+        ?p a foaf:Person ; foaf:name "x" .
+        ?p foaf:knows <http://example.org/q>
+    }
+'''
+        r = parseQuery(q)
+        assert r._index
+        r.expandIris()
+        iris = r.searchElements(element_type=SPARQLParser.IRIREF)
+        assert [str(i) for i in iris] == ['<http://xmlns.com/foaf/0.1/>', '<http://xmlns.com/foaf/0.1/Person>', '<http://xmlns.com/foaf/0.1/name>',
+                                        '<http://xmlns.com/foaf/0.1/knows>', '<http://example.org/q>'], iris
+        assert not r.searchElements(element_type=SPARQLParser.PrefixedName)
+        for kwargs in [dict(element_type=SPARQLParser.IRIREF), dict(element_type=SPARQLParser.iri, labeledOnly=True), dict(label='iri')]:
+            indexed = r.searchElements(**kwargs)
+            r.removeIndex()
+            assert [id(e) for e in r.searchElements(**kwargs)] == [id(e) for e in indexed], kwargs
+            r.buildIndex()
+        where = r.searchFirst(element_type=SPARQLParser.WhereClause)
+        where.buildIndex()
+        assert len(where.searchElements(element_type=SPARQLParser.VAR1)) == 2
+        where.searchFirst(element_type=SPARQLParser.TriplesBlock).updateWith('?q a ?r')
+        with r.batchEdit() as batch:
+            batch.replace(where.searchFirst(element_type=SPARQLParser.VAR1), '?s')
+        for e in [where, r]:
+            vars_ = e.searchElements(element_type=SPARQLParser.VAR1)
+            assert [str(v) for v in vars_][-2:] == ['?s', '?r'] and all(v.getRoot() is r for v in vars_), vars_
+
+    def testIterElements(self):
+        s = '<c:check#22?> ( $var, ?var )'
+        r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        preorder = list(r.iterElements())
+        postorder = list(r.iterElements(postorder=True))
+        assert len(preorder) == len(postorder) == 31
+        assert preorder[0] is r and postorder[-1] is r
+        assert [id(e) for e in preorder] == [id(e) for e in r.searchElements()[1:]]
+        arglist = r.searchFirst(element_type=SPARQLParser.ArgList)
+        assert arglist is r.searchElements(element_type=SPARQLParser.ArgList)[0]
+        pruned = list(r.iterElements(prune=lambda e: isinstance(e, SPARQLParser.ArgList)))
+        assert arglist in pruned and not any(e in pruned for e in arglist.getChildren())
+        pruned = list(r.iterElements(postorder=True, prune=lambda e: isinstance(e, SPARQLParser.ArgList)))
+        assert arglist in pruned and not any(e in pruned for e in arglist.getChildren())
+        assert r.searchFirst(element_type=SPARQLParser.WhereClause) is None
+
+    def testSearchValueAndText(self):
+        s = '<c:check#22?> ( $var, ?var )'
+        r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        byvalue = r.searchElements(value='$var')
+        bytext = r.searchElements(text='$var')
+        assert len(byvalue) == len(bytext) > 1
+        assert all(str(e) == '$var' for e in byvalue)
+        assert [id(e) for e in byvalue] == [id(e) for e in bytext]
+        assert r.searchElements(text='( $var , ?var )', element_type=SPARQLParser.ArgList)
+        assert not r.searchElements(text='($var, ?var)')
+        assert r.searchElements(value='($var, ?var)', element_type=SPARQLParser.ArgList)
+
+    def testValidation(self):
+        s = "'work' ^^<work:>"
+        r = SPARQLParser.RDFLiteral(s)
+        assert SPARQLParser.validation == 'full'
+        for validation in ['off', 'cheap', 'full']:
+            r.lexical_form.updateWith("'{}'".format(validation), validation=validation)
+            assert str(r) == "'{}' ^^ <work:>".format(validation)
+        try:
+            r.updateWith("'work'", validation='none')
+            assert False
+        except ParsertoolsException:
+            pass
+        try:
+            parseQuery('SELECT * { <a> <b> <c> }')
+            assert False
+        except AssertionError:
+            pass
+        SPARQLParser.setValidation('off')
+        try:
+            try:
+                parseQuery('SELECT * { <a> <b> <c> }')
+                assert False
+            except AssertionError:
+                pass
+            r = SPARQLParser.QueryUnit('SELECT * { <a> <b> <c> }', postParseCheck=False)
+        finally:
+            SPARQLParser.setValidation('full')
+        assert str(r) == 'SELECT * { <a> <b> <c> }'
+        try:
+            SPARQLParser.setValidation('none')
+            assert False
+        except ParsertoolsException:
+            pass
+
+    def testBatchEdit(self):
+        s = '<c:check#22?> ( $var, ?var )'
+        r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        vars_ = r.searchElements(element_type=SPARQLParser.Var)
+        with r.batchEdit() as batch:
+            batch.replace(vars_[0], '?a')
+            batch.replace(vars_[1], '?b')
+            assert str(r) == '<c:check#22?> ( $var , ?var )'
+        assert str(r) == '<c:check#22?> ( ?a , ?b )'
+        assert r._hashLen() == (_stringHash(str(r)), len(str(r))) and r.hasParentPointers()
+        assert [str(v) for v in r.searchElements(element_type=SPARQLParser.VAR1)] == ['?a', '?b']
+        try:
+            with r.batchEdit() as batch:
+                batch.replace(vars_[0], '?c')
+                batch.replace(vars_[1], '?')
+            assert False
+        except ParsertoolsException:
+            pass
+        assert str(r) == '<c:check#22?> ( ?a , ?b )'
+        batch = r.batchEdit()
+        batch.replace(vars_[0], '?c')
+        batch.replace(r.searchFirst(element_type=SPARQLParser.ArgList), '( ?d )')
+        try:
+            batch.commit()
+            assert False
+        except ParsertoolsException:
+            pass
+        assert str(r) == '<c:check#22?> ( ?a , ?b )'
+        with unittest.mock.patch.object(SPARQLParser.Var, 'isValid', side_effect=ParseException('')):
+            try:
+                with r.batchEdit() as batch:
+                    batch.replace(vars_[0], '?c')
+                assert False
+            except ParsertoolsException:
+                pass
+        assert str(r) == '<c:check#22?> ( ?a , ?b )' and r.hasParentPointers()
+        r = parseQuery('SELECT * WHERE { ?s ?p "abc" , "a" }')
+        literals = r.searchElements(element_type=SPARQLParser.STRING_LITERAL2)
+        literals[1].updateWith('"a\\tc"')
+        items = literals[0].getItems()
+        with unittest.mock.patch.object(SPARQLParser.STRING_LITERAL2, 'isValid', autospec=True, return_value=True) as isValid:
+            r.processEscapeSeqs()
+        assert literals[0].getItems() is items and [str(l) for l in literals] == ['"abc"', '"a\tc"']
+        assert [c[0][0] for c in isValid.call_args_list] == [literals[1]]
+
+    def testDeepTree(self):
+        depth = 5000
+        r = SPARQLParser.BracketedExpression(None)
+        r.setItems(['?var'])
+        for _ in range(depth):
+            parent = SPARQLParser.BracketedExpression(None)
+            parent.setItems(['(', r, ')'])
+            r = parent
+        assert str(r) == '( ' * depth + '?var' + ' )' * depth
+        assert r.hasParentPointers()
+        r.createParentPointers()
+        assert len(r.dump(step='').splitlines()) == 3 * depth + 2
+        assert len(r.searchElements()) == depth + 2
+        assert r.copy() == r
+
+    def testStreamingDumpAndRender(self):
+        s = '<c:check#22?> ( $var, ?var )'
+        r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        r.searchFirst(element_type=SPARQLParser.Var).updateWith('?other')
+        out = io.StringIO()
+        r.render(out=out)
+        assert r._str is None
+        cached = [e for e in r.iterElements() if e._str is not None]
+        dumped = io.StringIO()
+        assert r.dump(out=dumped) is None
+        assert [e for e in r.iterElements() if e._str is not None] == cached
+        assert out.getvalue() == str(r) + '\n' == '<c:check#22?> ( ?other , ?var )\n'
+        assert dumped.getvalue() == r.dump()
+
     def testBranchAndAtom(self):
         s = "'work' ^^<work:>"
         r = SPARQLParser.RDFLiteral(s)
@@ -139,6 +415,274 @@ SELECT ?p WHERE
         ancestors = arglist.getAncestors()
         assert str(ancestors) == '[iriOrFunction("<c:check#22?> ( $var , ?var )"), PrimaryExpression("<c:check#22?> ( $var , ?var )")]', str(ancestors)
 
+    def testNumbering(self):
+        s = '<c:check#22?> ( $var, ?var )'
+        r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        elements = list(r.iterElements())
+        assert all(e._pre is None for e in elements)
+        assert elements[-1].getDepth() > r.getDepth() == 0
+        assert [e._pre for e in elements] == sorted(e._pre for e in elements)
+        assert r.copy()._pre is None and r.copy(deep=False)._pre is None
+        for e in elements:
+            for f in elements:
+                assert e.isDescendantOf(f) == (f in e.getAncestors())
+        arglist = r.searchFirst(element_type=SPARQLParser.ArgList)
+        vars_ = r.searchElements(element_type=SPARQLParser.Var)
+        assert vars_[0].getCommonAncestor(vars_[1]) is arglist
+        assert vars_[0].getCommonAncestor(arglist) is arglist
+        assert vars_[0].getDepth() == len(vars_[0].getAncestors())
+        arglist.updateWith('( $var, ?var, ?other )')
+        vars_ = r.searchElements(element_type=SPARQLParser.Var)
+        assert len(vars_) == 3 and all(v.isDescendantOf(arglist) and arglist.isAncestorOf(v) for v in vars_)
+        assert vars_[2].getDepth() == len(vars_[2].getAncestors())
+        assert vars_[0].getCommonAncestor(vars_[2]) is arglist
+        assert not r.searchFirst(element_type=SPARQLParser.iri).isDescendantOf(arglist)
+        elements = list(r.iterElements())
+        assert [e._pre for e in elements] == sorted(e._pre for e in elements)
+        # Force a renumbering of the whole tree
+        arglist._set('_post', arglist._pre + 2)
+        arglist.updateWith('( $var, ?var )')
+        assert r.hasParentPointers() and arglist._post - arglist._pre > 2
+        assert all(v.isDescendantOf(arglist) for v in r.searchElements(element_type=SPARQLParser.Var))
+        elements = list(r.iterElements())
+        assert [e._pre for e in elements] == sorted(e._pre for e in elements)
+
+    def testSpans(self):
+        s = '<c:check#22?>   (  $var,?var )'
+        r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        assert r.getSpan() is None and r.getSource() is None
+        SPARQLParser.spans = True
+        try:
+            r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        finally:
+            SPARQLParser.spans = False
+        assert r.getSpan() == (0, len(s)) and r.getSource() == s and r.getParsedString() == s
+        arglist = r.searchFirst(element_type=SPARQLParser.ArgList)
+        assert arglist.getSource() == '(  $var,?var )' and str(arglist) == '( $var , ?var )'
+        var = r.searchFirst(element_type=SPARQLParser.Var)
+        assert var.getSpan() == (19, 23)
+        var.updateWith('?other')
+        assert arglist.getSource() is None and r.getSource() is None
+        assert r.searchFirst(element_type=SPARQLParser.iri).getSource() == '<c:check#22?>'
+        assert arglist.getParsedString() is None
+        q = 'SELECT * # comment\nWHERE { ?x ?y ?z }'
+        SPARQLParser.spans = True
+        try:
+            r = parseQuery(q)
+        finally:
+            SPARQLParser.spans = False
+        prepared = prepareQuery(q)
+        assert prepared != q and r.getParsedString() == prepared and r.getSpan() == (0, len(prepared))
+        var = r.searchFirst(element_type=SPARQLParser.Var)
+        assert var.getSpan() == (prepared.index('?x'), prepared.index('?x') + 2) and var.getSource() == '?x'
+
+    def testParentPointersOnConstruction(self):
+        s = '<c:check#22?> ( $var, ?var )'
+        r = SPARQLParser.PrimaryExpression._pattern.parseString(s, parseAll=True)[0]
+        assert r.getParent() is None and r.hasParentPointers()
+        r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        assert all(c.getParent() is r for c in r.getChildren())
+        assert r.hasParentPointers()
+
+    def testCollapse(self):
+        s = '?a + ?b * 2 || ?c && ( ?d > 1 ) || STRLEN ( ?e ) = 3'
+        eager = SPARQLParser.Expression(s, postParseCheck=False)
+        SPARQLParser.collapse = True
+        try:
+            r = SPARQLParser.Expression(s, postParseCheck=False)
+        finally:
+            SPARQLParser.collapse = False
+        assert r == eager and r.memoryReport() != eager.memoryReport()
+        stored = sum(1 for _ in r._iterStored())
+        assert 3 * stored < sum(1 for _ in eager.iterElements())
+        assert r.dump() == eager.dump() and r.hasParentPointers() and sum(1 for _ in r._iterStored()) == stored
+        assert len(r.searchElements(element_type=SPARQLParser.Var)) == 5 and sum(1 for _ in r._iterStored()) == stored + 5
+        assert r.searchFirst(element_type=SPARQLParser.Var).getParent().__class__ is SPARQLParser.PrimaryExpression
+        assert sum(1 for _ in r._iterStored()) == stored + 6
+        var = r.searchElements(element_type=SPARQLParser.Var)[2]
+        assert isinstance(var, SPARQLParser.Var) and str(var) == '?c'
+        expected = eager.searchElements(element_type=SPARQLParser.Var)[2]
+        assert [a.__class__ for a in var.getAncestors()] == [a.__class__ for a in expected.getAncestors()]
+        assert var.getDepth() == expected.getDepth() and var.isDescendantOf(r)
+        assert [str(e) for e in r.searchElements(element_type=SPARQLParser.PrimaryExpression)] == \
+               [str(e) for e in eager.searchElements(element_type=SPARQLParser.PrimaryExpression)]
+        var.updateWith('?z')
+        assert str(r) == '?a + ?b * 2 || ?z && ( ?d > 1 ) || STRLEN ( ?e ) = 3' and r.hasParentPointers()
+        assert r.copy() == r and r.copy(lazy=True) == r
+
+    def testSharedLeaves(self):
+        s = '<c:check#22?> ( DISTINCT $var, ?var )'
+        eager = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+        SPARQLParser.shareLeaves = SPARQLParser.spans = True
+        try:
+            r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+            r2 = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+            q1 = parseQuery('PREFIX a: <http://a/> SELECT * WHERE { ?x a:b ?y }')
+            q2 = parseQuery('PREFIX c: <http://c/> SELECT * WHERE { ?x c:d ?y }')
+            q3 = parseQuery('SELECT * WHERE { ?x <http://a/b> ?y }')
+            select = q3.searchFirst(element_type=SPARQLParser.SELECT)
+            select.updateWith('SELECT')
+            with q3.batchEdit() as edit:
+                edit.replace(q3.searchFirst(element_type=SPARQLParser.WHERE), 'WHERE')
+            q4 = parseQuery('SELECT * WHERE { ?x <http://a/b> ?y . ?z ?p ?o }')
+            ggps = q4.searchElements(element_type=SPARQLParser.GroupGraphPattern)
+            ggps[0].getChildren()
+            ggps[0].updateWith('{ ?a ?b ?c }')
+            q5 = parseQuery('SELECT * WHERE { ?x <http://a/b> ?y }')
+            ggp = q5.searchFirst(element_type=SPARQLParser.GroupGraphPattern)
+            ggp.getChildren()
+            with q5.batchEdit() as edit:
+                edit.replace(ggp, '{ ?a ?b ?c }')
+        finally:
+            SPARQLParser.shareLeaves = SPARQLParser.spans = False
+        assert r == eager and str(r) == str(eager)
+        assert r.getSize(recursive=True) < eager.getSize(recursive=True)
+        shared = [e for e in r._iterStored() if e._isShared()]
+        assert shared and [e for e in r2._iterStored() if e._isShared()] == shared
+        assert all(e._isShared() and e.getPrefixes() == {} for e in q1._iterStored() if isinstance(e, SPARQLParser.WHERE))
+        assert r.hasParentPointers() and r.dump() == eager.dump() and r.searchFirst(element_type=SPARQLParser.Var)
+        assert [e for e in r._iterStored() if e._isShared()] == shared
+        lpar = r.searchFirst(element_type=SPARQLParser.LPAR)
+        assert not lpar._isShared() and lpar.getParent() is r.searchFirst(element_type=SPARQLParser.ArgList) and lpar.getRoot() is r
+        assert lpar.isDescendantOf(r) and lpar.getDepth() == eager.searchFirst(element_type=SPARQLParser.LPAR).getDepth()
+        assert r.searchFirst(element_type=SPARQLParser.DISTINCT).getLabel() == 'distinct'
+        assert r.searchFirst(element_type=SPARQLParser.ArgList).getSource() == '( DISTINCT $var, ?var )'
+        assert r2.searchFirst(element_type=SPARQLParser.LPAR) is not lpar
+        self.assertRaises(ParsertoolsException, shared[0]._set, '_label', 'x')
+        r.searchFirst(element_type=SPARQLParser.Var).updateWith('?other')
+        assert str(r) == '<c:check#22?> ( DISTINCT ?other , ?var )' and lpar.getRoot() is r
+        assert q1.searchFirst(element_type=SPARQLParser.WHERE).getPrefixes() == {'a:': 'http://a/'}
+        assert any(e._isShared() for e in q1._iterStored()) and not any(e._isShared() for e in q1.iterElements())
+        assert q2.searchFirst(element_type=SPARQLParser.WHERE).getPrefixes() == {'c:': 'http://c/'}
+        where = q3.searchFirst(element_type=SPARQLParser.WHERE)
+        assert not select._isShared() and not where._isShared() and str(q3) == 'SELECT * WHERE { ?x <http://a/b> ?y }'
+        select.updateWith('SELECT')
+        where._set('_label', where._label)
+        for q in q4, q5:
+            assert str(q) == 'SELECT * WHERE { ?a ?b ?c }' and q._index is not None
+            assert [str(v) for v in q.searchElements(element_type=SPARQLParser.Var)] == ['?a', '?b', '?c']
+
+    def testInternTable(self):
+        table = InternTable(maxsize=3)
+        assert table.intern('a' * 3) is table.intern(''.join(['aaa'])) and len(table) == 1
+        for s in ['b', 'c', 'd']:
+            table.intern(s)
+        assert len(table) == 3 and not 'aaa' in table._strings
+        q = 'PREFIX p: <http://a/> SELECT ?x WHERE { ?x p:b <http://x/y> . ?x p:c <http://x/y> }'
+        SPARQLParser.internTable = InternTable()
+        try:
+            r1 = parseQuery(q)
+            r2 = parseQuery(q)
+        finally:
+            SPARQLParser.internTable = None
+        iris1 = [i.getItems()[0] for i in r1.searchElements(element_type=SPARQLParser.IRIREF)]
+        iris2 = [i.getItems()[0] for i in r2.searchElements(element_type=SPARQLParser.IRIREF)]
+        assert iris1[1] is iris1[2] is iris2[1]
+        names = r1.searchElements(element_type=SPARQLParser.PrefixedName)
+        assert names[0].getPrefixes() is names[1].getPrefixes() == {'p:': 'http://a/'}
+        assert list(names[0].getPrefixes())[0] is list(r2.searchFirst(element_type=SPARQLParser.PrefixedName).getPrefixes())[0]
+
+    def testGarbageCollection(self):
+        s = '<c:check#22?> ( $var, ?var )'
+        SPARQLParser.weakParents = SPARQLParser.pauseGC = True
+        gc.disable()
+        try:
+            r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
+            assert set(SPARQLParser.gcStats) == {'seconds', 'objects', 'counts'} and not gc.isenabled()
+            assert r.hasParentPointers() and r.isValid()
+            var = r.searchFirst(element_type=SPARQLParser.Var)
+            assert var.getAncestors()[-1] is r
+            var.updateWith('?other')
+            assert str(r) == '<c:check#22?> ( ?other , ?var )'
+            r_copy = r.copy()
+            child = r_copy.getChildren()[0]
+            ref = weakref.ref(r_copy)
+            del r_copy
+            assert ref() is None and child.getParent() is None
+        finally:
+            SPARQLParser.weakParents = SPARQLParser.pauseGC = False
+            gc.enable()
+        freezeTrees()
+        assert gc.get_freeze_count() > 0
+        unfreezeTrees()
+        assert gc.get_freeze_count() == 0
+
+    def testDispatcher(self):
+        s = 'SELECT ?x WHERE { ?x ?p ?o FILTER ( STRLEN ( STR ( ?o ) ) > 3 || NOT EXISTS { ?x ?p 1 } ) BIND ( COUNT ( DISTINCT ?o ) AS ?y ) }'
+        r = SPARQLParser.QueryUnit(s)
+        tables = SPARQLParser.dispatcher._tables.values()
+        builtins = [p for p, _ in tables if SPARQLParser.Aggregate._pattern in p.exprs]
+        assert len(builtins) == 1 and not SPARQLParser.dispatcher._tables[id(builtins[0])][1][4]
+        assert all(type(p) is _DispatchingMatchFirst for p, _ in tables)
+        for p, _ in tables:
+            p.__class__ = MatchFirst
+        try:
+            plain = SPARQLParser.QueryUnit(s)
+        finally:
+            for p, _ in tables:
+                p.__class__ = _DispatchingMatchFirst
+        assert r == plain and r.dump() == plain.dump()
+        self.assertRaises(SPARQLParseException, parseQuery, 'SELECT * { FILTER ( STRLEN ( ) ) }')
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            assert all(t == r for t in executor.map(SPARQLParser.QueryUnit, [s] * 8))
+        extended = builtins[0].copy()
+        extended.append(Literal('!'))
+        assert type(extended) is _DispatchingMatchFirst and list(extended.parseString('!')) == ['!']
+        assert str(extended.parseString('STRLEN ( ?x )')) == str(builtins[0].parseString('STRLEN ( ?x )'))
+        first = lambda regex: _firstChars(re.compile(regex))
+        assert first(SPARQLParser.VAR1._pattern.pattern) == ({'?'}, False) and first(r'(?:-|\+)?\d+') == (set('-+0123456789'), True)
+        assert first(r'(?=a)b{1,}|[]\u00e9]') == ({'b', ']'}, True) and first('[^\x00-\x7f]') == (set(), True)
+        assert first('a*') is None and first('(a|)') is None and first(r'(?i)a') is None and first(r'(a)\1') is None
+
+    def testGrammarAnalysis(self):
+        report = reportGrammar(SPARQLParser)
+        assert 'Update1 (11 alternatives)' in report and 'RelationalExpression (8 alternatives)' in report
+        toy = Parser()
+        for name in 'ABCDEF':
+            toy.addElement(Literal(name.lower()).setName(name))
+        A, B, C, D, E, F = (getattr(toy, name)._pattern for name in 'ABCDEF')
+        toy.addElement(Group(A + B + C('c') | A + B + D | E | A + F).setName('Toy'))
+        [alternation] = analyzeGrammar(toy)
+        assert alternation.element == 'Toy' and alternation.overlaps == [(0, 1, 2), (0, 3, 1), (1, 3, 1)] and alternation.cost == 4
+        assert 'Toy (4 alternatives): cost 4, overlapping alternatives 1/2 (prefix 2), 1/4 (prefix 1), 2/4 (prefix 1)' in reportGrammar(toy)
+        assert not any(prefix for a in analyzeGrammar(SPARQLParser) for _, _, prefix in a.overlaps)
+
+    def testGeneratedParser(self):
+        source = generateParser(SPARQLParser)
+        assert source == generateParser(SPARQLParser)
+        def load(source):
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'sparqlgenerated.py')
+                with open(path, 'w') as f:
+                    f.write(source)
+                spec = importlib.util.spec_from_file_location('sparqlgenerated', path)
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+            return module
+        module = load(source)
+        imports = [line for line in source.splitlines() if line.startswith(('import ', 'from '))]
+        assert not any('sparqlparser' in line or re.search(r'parsertools.* import .*\b_', line) for line in imports)
+        assert loadParser(SPARQLParser).FINGERPRINT == module.FINGERPRINT and module.PYPARSING_VERSION == pyparsing.__version__
+        other = load(source.replace(module.FINGERPRINT, '0' * 40))
+        with self.assertRaises(ParsertoolsException) as context:
+            other.parse(SPARQLParser.Var, '?x')
+        assert pyparsing.__version__ in str(context.exception)
+        with self.assertRaises(ParseException) as context:
+            module.parse(SPARQLParser.Var, '?x ?y')
+        assert context.exception.loc == 3
+        self.assertRaises(ParseException, module.parse, SPARQLParser.Var, ' x')
+        cases = [(SPARQLParser.QueryUnit, 'PREFIX ex: <http://example.org/> SELECT DISTINCT ?x (COUNT(*) AS ?n) WHERE { ?x ex:p "a"@en, 3.0e+4 ; a ?t OPTIONAL { ?x ex:q ?y FILTER ( ?y NOT IN ( 1, 2 ) ) } } GROUP BY ?x'),
+                 (SPARQLParser.UpdateUnit, 'INSERT DATA { <http://a> <http://b> """c""" } ; DELETE WHERE { ?s ?p ?o }'),
+                 (SPARQLParser.PathMod, '?'), (SPARQLParser.Var, ' ?x\t')]
+        plain = [c(s) for c, s in cases]
+        SPARQLParser.compiled = module
+        try:
+            compiled = [c(s) for c, s in cases]
+            self.assertRaises(SPARQLParseException, parseQuery, 'SELECT * WHERE { ?x ?y }')
+        finally:
+            SPARQLParser.compiled = None
+        assert [r.dump() for r in compiled] == [r.dump() for r in plain] and compiled[0] == plain[0]
+
     def testParseQuery(self):
         s = 'BASE <work:22?> SELECT REDUCED $var1 ?var2 (("*Expression*") AS $var3) { SELECT * {} } GROUP BY ROUND ( "*Expression*") VALUES $S { <t:testIri> <t:testIri> }'
         parseQuery(s)
@@ -525,6 +1069,9 @@ prologue:/exttra
             r_answer2 += '\n'
         
         assert answer2.strip() == r_answer2.strip()
+        q1 = parseQuery('SELECT * WHERE { ?x ?y ?z }')
+        q2 = parseQuery('SELECT * WHERE { ?x ?y ?z }')
+        assert q1.getPrefixes() == {} and not q1.getPrefixes() is q2.getPrefixes()
         
     def testExpandIris(self):
         s1 = '''
@@ -2102,5 +2102,27 @@ class Test(unittest.TestCase):
     def testQueryUnit(self):
         Test.makeTestFunc('QueryUnit', self.testCases, debug=0)()
         
+class GeneratedParserTest(unittest.TestCase):
+    '''Compares the parses of the parser module generated for the grammar (see parsertools.generator) with those of the grammar,
+    for the test cases of the rules that Test tests. The generator is imported in setUpClass(), so that the tests of Test do not depend on it.'''
+
+    @classmethod
+    def setUpClass(cls):
+        from parsertools.generator import loadParser
+        cls.compiled = loadParser(SPARQLParser)
+
+    def testGeneratedParser(self):
+        grammarTest = Test()
+        grammarTest.setUp()
+        for rule, testCases in grammarTest.testCases.items():
+            if not hasattr(Test, 'test' + rule):
+                continue
+            class_ = getattr(SPARQLParser, rule)
+            for p in testCases['pass']:
+                e = class_._pattern.parseString(p, parseAll=True)
+                assert self.compiled.parse(class_, p).dump() == e[0].dump(), 'Generated parser conflicts with grammar for "{}"'.format(p)
+            for f in testCases['fail']:
+                self.assertRaises(ParseException, self.compiled.parse, class_, f)
+
 if __name__ == "__main__":
     unittest.main()